@@ -0,0 +1,348 @@
+"""
+Benchmark offline cho các đường nóng của bot (không cần token, không gọi Discord/Roblox thật).
+
+- Kênh Discord giả: đếm API call, cộng độ trễ giả lập cho mỗi call, đo số byte upload (embed JSON + file).
+- Server aiohttp cục bộ đóng vai Roblox thumbnails API + CDN avatar/logo.
+- Chạy với board 10 / 100 / 1000 người, đo wall time, số API call, byte upload và peak RAM (tracemalloc).
+
+Dùng:
+    python bench.py                          # in bảng kết quả
+    python bench.py --json base.json         # lưu kết quả
+    python bench.py --compare base.json      # so với lần chạy trước, exit 1 nếu có regression
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from aiohttp import web
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SIZES = (10, 100, 1000)
+LATENCY = 0.002      # giây giả lập cho mỗi API call Discord
+CDN_LATENCY = 0.005  # giây giả lập cho mỗi request tới thumbnails API/CDN
+THRESHOLD = 0.25     # wall time chậm hơn 25% so với baseline -> regression
+
+# --- FAKE DISCORD ---
+_snowflakes = itertools.count(1_300_000_000_000_000_000)
+
+class FakeMessage:
+    def __init__(self, channel, embeds=(), file=None, author=None):
+        self.channel = channel
+        self.id = next(_snowflakes)
+        self.embeds = list(embeds)
+        self.attachments = [file] if file else []
+        self.author = author
+        self.pinned = False
+
+class FakePartialMessage:
+    def __init__(self, channel, msg_id):
+        self.channel = channel
+        self.id = msg_id
+    async def edit(self, embeds=None, embed=None):
+        msg = await self.channel._call(self.channel._get, self.id)
+        msg.embeds = [embed] if embed else list(embeds or ())
+        self.channel.bytes_uploaded += _embed_bytes(msg.embeds)
+        return msg
+    async def delete(self):
+        await self.channel._call(self.channel._get, self.id)
+        self.channel.messages.pop(self.id, None)
+
+def _embed_bytes(embeds):
+    return sum(len(json.dumps(e.to_dict(), ensure_ascii=False).encode("utf-8")) for e in embeds)
+
+def _file_bytes(file):
+    fp = file.fp
+    pos = fp.tell()
+    size = fp.seek(0, io.SEEK_END)
+    fp.seek(pos)
+    return size - pos
+
+class FakeChannel:
+    """Đủ API mà index.py dùng: send / get_partial_message / fetch_message / delete_messages / purge / history."""
+    def __init__(self, me, latency=LATENCY):
+        self.id = next(_snowflakes)
+        self.me = me
+        self.guild = SimpleNamespace(id=next(_snowflakes), me=me)
+        self.latency = latency
+        self.messages = {}  # id -> FakeMessage, id tăng dần theo thời gian gửi
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.bytes_uploaded = 0
+
+    async def _call(self, fn=None, *args):
+        self.calls += 1
+        if self.latency: await asyncio.sleep(self.latency)
+        return fn(*args) if fn else None
+
+    def _get(self, msg_id):
+        import discord
+        msg = self.messages.get(msg_id)
+        if msg is None: raise discord.NotFound(SimpleNamespace(status=404, reason="Not Found"), "Unknown Message")
+        return msg
+
+    async def send(self, content=None, embed=None, embeds=None, file=None):
+        await self._call()
+        embeds = [embed] if embed else list(embeds or ())
+        self.bytes_uploaded += _embed_bytes(embeds) + (_file_bytes(file) if file else 0)
+        msg = FakeMessage(self, embeds, file, author=self.me)
+        self.messages[msg.id] = msg
+        return msg
+
+    def get_partial_message(self, msg_id):
+        return FakePartialMessage(self, msg_id)
+
+    async def fetch_message(self, msg_id):
+        return await self._call(self._get, msg_id)
+
+    async def delete_messages(self, objs):
+        await self._call()
+        for o in objs: self.messages.pop(o.id, None)
+
+    async def purge(self, limit=100, check=None):
+        await self._call()
+        for msg_id in sorted(self.messages, reverse=True)[:limit]:
+            if check is None or check(self.messages[msg_id]): del self.messages[msg_id]
+
+    def history(self, limit=None, after=None, oldest_first=None, before=None):
+        if oldest_first is None: oldest_first = after is not None
+        async def pages():
+            ids = sorted(self.messages, reverse=not oldest_first)
+            if after is not None: ids = [i for i in ids if i > after.id]
+            if limit is not None: ids = ids[:limit]
+            for n, msg_id in enumerate(ids):
+                if n % 100 == 0: await self._call()  # mỗi trang lịch sử 100 message = 1 request
+                msg = self.messages.get(msg_id)
+                if msg is not None: yield msg
+            # Như discord.py: chỉ dừng khi nhận trang chưa đầy, nên trang rỗng cuối cùng vẫn tốn một request
+            if len(ids) % 100 == 0: await self._call()
+        return pages()
+
+# --- FAKE ROBLOX / CDN ---
+class FakeCDN:
+    """Thumbnails API (userIds=a,b,c) + CDN ảnh có ETag, chạy trên 127.0.0.1 cổng ngẫu nhiên."""
+    def __init__(self, latency=CDN_LATENCY):
+        self.latency = latency
+        self.requests = 0
+        self.bytes_sent = 0
+        self.base = None
+        self.image = None
+
+    async def thumbnails(self, request):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        ids = [i for i in request.query.get("userIds", "").split(",") if i]
+        return web.json_response({"data": [{"targetId": int(i), "state": "Completed", "imageUrl": f"{self.base}/img/{i}.png"} for i in ids]})
+
+    async def asset(self, request):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        if request.headers.get("If-None-Match") == '"bench"': return web.Response(status=304)
+        self.bytes_sent += len(self.image)
+        return web.Response(body=self.image, content_type="image/png", headers={"ETag": '"bench"'})
+
+    async def start(self):
+        from PIL import Image
+        buf = io.BytesIO()
+        Image.new("RGBA", (420, 420), (200, 40, 40, 255)).save(buf, format="PNG")
+        self.image = buf.getvalue()
+        app = web.Application()
+        app.router.add_get("/v1/users/avatar-headshot", self.thumbnails)
+        app.router.add_get("/img/{name}", self.asset)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base = f"http://127.0.0.1:{port}"
+        return self
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+# --- SCENARIOS ---
+def make_players(index, n, cdn):
+    return [index.PlayerRecord(
+        r, username=f"player{r}", mention_id=100000 + r, displayname=f"Player {r}",
+        stage=("god", "mythic", "legend", "semi")[r % 4], roblox_id=str(5000 + r), country="Vietnam",
+        avatar_url=f"{cdn.base}/img/{5000 + r}.png", avatar_at=time.time()
+    ) for r in range(1, n + 1)]
+
+def make_table(index, players):
+    table = index.RankTable()
+    for p in players: table.insert(p)
+    return table
+
+async def measure(results, name, size, coro_fn, counter=None):
+    """Chạy một kịch bản, ghi wall time / API call / byte upload / peak RAM."""
+    if counter: counter.reset()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        extra = await coro_fn()
+    wall = time.perf_counter() - t0
+    row = {"scenario": name, "size": size, "wall_s": round(wall, 5),
+           "api_calls": counter.calls if counter else 0,
+           "bytes_uploaded": counter.bytes_uploaded if counter else 0,
+           "peak_kib": round((tracemalloc.get_traced_memory()[1] - base) / 1024, 1)}
+    if isinstance(extra, dict): row.update(extra)
+    results.append(row)
+    return row
+
+async def bench_size(index, cdn, session, n, results):
+    me = index.bot.user  # scan_history chỉ nhận message có author == bot.user
+    cid = "900"
+    players = make_players(index, n, cdn)
+
+    # JSON: load_json / save_json và ghi nền của LeaderboardStore
+    path = f"bench_{n}.json"
+    raw = {cid: {"players": [p.to_dict() for p in players], "img_msg_id": None}}
+    async def save(): index.save_json(path, raw)
+    async def load(): index.load_json(path)
+    await measure(results, "save_json", n, save)
+    await measure(results, "load_json", n, load)
+    store = index.LeaderboardStore(path, delay=0)
+    async def flush():
+        store.mark_dirty(cid)
+        await store.flush()
+    await measure(results, "store_flush", n, flush)
+
+    # Board: dựng lần đầu, đối chiếu không đổi, move/exchange (edit_mode), remove (reconcile)
+    channel = FakeChannel(me)
+    data = {cid: {"players": make_table(index, players), "img_msg_id": None}}
+    table = data[cid]["players"]
+    await measure(results, "update_board_initial", n, lambda: index.update_board(channel, cid, data), channel)
+    await measure(results, "update_board_noop", n, lambda: index.update_board(channel, cid, data), channel)
+    async def move():
+        changed = table.move(n, 1)
+        await index.update_board(channel, cid, data, edit_mode=True, changed=changed)
+    await measure(results, "move_edit_mode", n, move, channel)
+    async def exchange():
+        changed = table.swap(1, n)
+        await index.update_board(channel, cid, data, edit_mode=True, changed=changed)
+    await measure(results, "exchange_edit_mode", n, exchange, channel)
+    async def remove():
+        table.remove(max(1, n // 2))
+        await index.update_board(channel, cid, data)
+    await measure(results, "remove_reconcile", n, remove, channel)
+    first, last = table.top(1)[0].rank, max(r.rank for r in table)
+    async def move_table():
+        for _ in range(100): table.move(first, last)
+    await measure(results, "rank_table_move_x100", n, move_table)
+
+    # Hồi phục từ lịch sử kênh: quét toàn bộ rồi quét tăng dần theo checkpoint
+    fresh = {}
+    interaction = SimpleNamespace(channel=channel)
+    async def sync():
+        await index.ensure_data_sync(interaction, fresh, cid)
+        return {"recovered": len(fresh[cid]["players"])}
+    await measure(results, "ensure_data_sync", n, sync, channel)
+    await measure(results, "recover_incremental", n, lambda: index.recover_channel(channel, cid, fresh), channel)
+
+    # Avatar: resolve theo lô qua thumbnails API
+    resolver = index.ThumbnailResolver(api_url=f"{cdn.base}/v1/users/avatar-headshot")
+    resolver.session = session
+    async def resolve():
+        before = cdn.requests
+        await resolver.resolve_many(p.roblox_id for p in players)
+        return {"http_requests": cdn.requests - before}
+    await measure(results, "resolve_avatars", n, resolve)
+
+async def bench_render(index, cdn, session, results):
+    players = make_players(index, 10, cdn)
+    async def render(cold):
+        if cold:
+            index.assets = index.AssetCache(tempfile.mkdtemp(prefix="assets_", dir="."))
+            index._template, index._template_has_logo = None, False
+        before = (cdn.requests, cdn.bytes_sent)
+        file = await index.create_top_player_image(players, session)
+        return {"http_requests": cdn.requests - before[0], "bytes_downloaded": cdn.bytes_sent - before[1], "image_bytes": _file_bytes(file)}
+    await measure(results, "render_summary_cold", 10, lambda: render(True))
+    await measure(results, "render_summary_warm", 10, lambda: render(False))
+
+async def run(sizes):
+    import aiohttp
+    import index
+    tracemalloc.start()
+    results = []
+    cdn = await FakeCDN().start()
+    try:
+        async with aiohttp.ClientSession() as session:
+            # Mọi request của bot (logo, avatar) đi qua CDN giả
+            index.bot.session = session
+            index.SCP_LOGO_URL = f"{cdn.base}/img/logo.png"
+            for n in sizes: await bench_size(index, cdn, session, n, results)
+            await bench_render(index, cdn, session, results)
+    finally:
+        await cdn.stop()
+        tracemalloc.stop()
+    return results
+
+# --- REPORT ---
+def key(row): return f"{row['scenario']}[{row['size']}]"
+
+BASE_FIELDS = ("scenario", "size", "wall_s", "api_calls", "bytes_uploaded", "peak_kib")
+
+def print_table(results):
+    print(f"{'scenario':<24}{'size':>6}{'wall ms':>11}{'calls':>7}{'upload KiB':>12}{'peak KiB':>11}  extra")
+    for r in results:
+        extra = " ".join(f"{k}={v}" for k, v in r.items() if k not in BASE_FIELDS)
+        print(f"{r['scenario']:<24}{r['size']:>6}{r['wall_s'] * 1000:>11.1f}{r['api_calls']:>7}{r['bytes_uploaded'] / 1024:>12.1f}{r['peak_kib']:>11.1f}  {extra}")
+
+def compare(results, baseline, threshold):
+    """So với baseline: API call / request / byte tăng là regression, wall time chỉ tính khi vượt ngưỡng."""
+    old = {key(r): r for r in baseline["results"]}
+    regressions = []
+    for r in results:
+        b = old.get(key(r))
+        if b is None: continue
+        for field in ("api_calls", "http_requests", "bytes_uploaded"):
+            if r.get(field, 0) > b.get(field, 0):
+                regressions.append(f"{key(r)} {field}: {b.get(field, 0)} -> {r.get(field, 0)}")
+        if r["wall_s"] > b["wall_s"] * (1 + threshold) and r["wall_s"] - b["wall_s"] > 0.005:
+            regressions.append(f"{key(r)} wall_s: {b['wall_s']:.4f} -> {r['wall_s']:.4f}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark for the leaderboard bot hot paths.")
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)), help="board sizes, comma separated")
+    parser.add_argument("--json", metavar="PATH", help="write results as JSON")
+    parser.add_argument("--compare", metavar="PATH", help="baseline JSON from a previous run")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD, help="allowed wall time slowdown (0.25 = 25%%)")
+    args = parser.parse_args()
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+
+    # Chạy trong thư mục tạm: index.py đọc/ghi DATA_FILE, asset_cache, ... theo cwd
+    sys.path.insert(0, HERE)
+    out = {"python": sys.version.split()[0], "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "latency_s": LATENCY, "cdn_latency_s": CDN_LATENCY}
+    with tempfile.TemporaryDirectory(prefix="topbot_bench_") as workdir:
+        os.chdir(workdir)
+        try: out["results"] = asyncio.run(run(sizes))
+        finally: os.chdir(HERE)
+    print_table(out["results"])
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f: json.dump(out, f, indent=2)
+        print(f"\n💾 Saved {args.json}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f: baseline = json.load(f)
+        regressions = compare(out["results"], baseline, args.threshold)
+        if regressions:
+            print("\n❌ Regressions:")
+            for line in regressions: print(f"  {line}")
+            sys.exit(1)
+        print("\n✅ No regressions")
+
+if __name__ == "__main__":
+    main()
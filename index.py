@@ -1,33 +1,89 @@
+import time
+BOOT_STARTED = time.perf_counter()  # mốc đo cold start (tính cả thời gian import)
 import discord
 from discord import app_commands
 from discord.ext import commands
 import json
+import hashlib
+import bisect
 import os
+import asyncio
 import aiohttp
+from aiohttp import web
 import io
+import csv
 import re
 import signal
+import functools
+import math
+import logging
+import contextlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
-from PIL import Image, ImageDraw, ImageFont
 from dotenv import load_dotenv
-from flask import Flask
-from threading import Thread
+from threading import Lock
 
 # --- 1. WEB SERVER (KEEP ALIVE) ---
-app = Flask('')
+# aiohttp chạy ngay trên event loop của bot (khởi động trong setup_hook), không cần Flask/thread riêng.
+summary_images = {}  # cid -> (bytes, content_type, etag) của ảnh tổng hợp render gần nhất
+_board_json = {}     # cid -> (version dữ liệu, bytes, etag)
 
-@app.route('/')
-def home():
-    return "Bot Leaderboard & Security System Online!"
+def _etag(raw):
+    return '"' + hashlib.sha1(raw).hexdigest() + '"'
 
-def run_server():
-    port = int(os.environ.get('PORT', 8080))
-    app.run(host='0.0.0.0', port=port)
+def _cached_response(request, body, content_type, etag):
+    tags = [t.strip() for t in request.headers.get("If-None-Match", "").split(",")]
+    if etag in tags or "*" in tags:
+        return web.Response(status=304, headers={"ETag": etag})
+    return web.Response(body=body, content_type=content_type, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+async def home(request):
+    return web.Response(text="Bot Leaderboard & Security System Online!")
+
+async def metrics_endpoint(request):
+    return web.Response(body=metrics.render().encode("utf-8"), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+async def healthz(request):
+    connected = bot.is_ready() and not bot.is_closed()
+    latency = bot.latency
+    body = {"connected": connected, "latency": None if math.isnan(latency) or math.isinf(latency) else round(latency, 4), "guilds": len(bot.guilds)}
+    return web.json_response(body, status=200 if connected else 503)
+
+async def board_json(request):
+    """Board chỉ đọc, dựng từ dữ liệu trong RAM; chỉ serialize lại khi kênh có thay đổi."""
+    cid = request.match_info["cid"]
+    entry = store.data.get(cid)
+    if entry is None: raise web.HTTPNotFound()
+    version = store.versions.get(cid, 0)
+    cached = _board_json.get(cid)
+    if cached is None or cached[0] != version:
+        players = [{k: v for k, v in rec.to_dict().items() if k not in ("msg_id", "slot", "avatar_at")} for rec in entry["players"]]
+        body = json.dumps({"channel_id": cid, "players": players}, ensure_ascii=False).encode("utf-8")
+        cached = _board_json[cid] = (version, body, _etag(body))
+    return _cached_response(request, cached[1], "application/json", cached[2])
 
-def keep_alive():
-    t = Thread(target=run_server)
-    t.daemon = True
-    t.start()
+async def board_image(request):
+    """Ảnh tổng hợp render gần nhất của kênh, không render lại. Đuôi URL phải khớp SUMMARY_FORMAT (.png/.webp)."""
+    cached = summary_images.get(request.match_info["cid"])
+    if cached is None or cached[1] != f"image/{request.match_info['ext']}": raise web.HTTPNotFound()
+    return _cached_response(request, *cached)
+
+def create_web_app():
+    web_app = web.Application()
+    web_app.router.add_get('/', home)
+    web_app.router.add_get('/metrics', metrics_endpoint)
+    web_app.router.add_get('/healthz', healthz)
+    web_app.router.add_get(r'/boards/{cid:\d+}.json', board_json)
+    web_app.router.add_get(r'/boards/{cid:\d+}.{ext:png|webp}', board_image)
+    return web_app
+
+async def start_web_server():
+    runner = web.AppRunner(create_web_app(), access_log=None)
+    await runner.setup()
+    port = int(os.environ.get('PORT', 8080))
+    await web.TCPSite(runner, '0.0.0.0', port).start()
+    return runner
 
 # --- 2. CONFIGURATION ---
 load_dotenv()
@@ -36,10 +92,21 @@ TOKEN = os.getenv("DISCORD_TOKEN")
 DATA_FILE = "topplayers_data.json"
 AUTH_FILE = "authorized_users.json"
 BLACKLIST_FILE = "blacklist_data.json"
+COMMAND_HASH_FILE = "command_tree.hash"
 BOT_OWNER_ID = 626404653139099648 
 SCP_LOGO_URL = "https://upload.wikimedia.org/wikipedia/commons/thumb/e/ec/SCP_Foundation_logo.svg/1200px-SCP_Foundation_logo.svg.png"
 DECORATION_GIF = "https://cdn.discordapp.com/attachments/1327188364885102594/1443075988580995203/fixedbulletlines.gif"
 
+HTTP_POOL_SIZE = 20       # số kết nối giữ lại trong pool của session dùng chung
+HTTP_PER_HOST = 10
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=20, connect=5, sock_read=10)
+THUMBNAIL_API = os.getenv("ROBLOX_THUMBNAIL_API", "https://thumbnails.roblox.com/v1/users/avatar-headshot")
+
+# Gateway gọn: chỉ intent guilds (kênh, role, event role), không cache member/presence/message.
+# Đặt LEAN_GATEWAY=0 để quay lại Intents.all(); SHARDED=1 để chạy AutoShardedBot khi bot ở rất nhiều server.
+LEAN_GATEWAY = os.getenv("LEAN_GATEWAY", "1") != "0"
+SHARDED = os.getenv("SHARDED", "0") == "1"
+
 # Tên các Role trong Discord phải trùng khớp chính xác với các tên này
 RANK_ROLES = {
     "god": "GOD",
@@ -48,7 +115,128 @@ RANK_ROLES = {
     "semi": "Semi Legendary"
 }
 
+# --- 2b. METRICS ---
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+CALL_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+class Metrics:
+    """
+    Counter/histogram/gauge tối giản, xuất dạng text Prometheus cho /metrics.
+    Không cần lock: mọi chỗ ghi và web server /metrics đều chạy trên event loop của bot.
+    """
+    def __init__(self):
+        self._meta = {}      # name -> (kiểu, help, buckets)
+        self._series = {}    # name -> {labels: giá trị hoặc [bucket..., sum, count]}
+        self._gauges = {}    # name -> hàm trả về số
+
+    def describe(self, name, kind, help, buckets=LATENCY_BUCKETS):
+        self._meta[name] = (kind, help, buckets)
+
+    def gauge(self, name, fn, help, kind="gauge"):
+        self.describe(name, kind, help)
+        self._gauges[name] = fn
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self._series.setdefault(name, {})
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        buckets = self._meta.get(name, (None, None, LATENCY_BUCKETS))[2]
+        key = tuple(sorted(labels.items()))
+        series = self._series.setdefault(name, {})
+        h = series.get(key)
+        if h is None: h = series[key] = [0] * len(buckets) + [0.0, 0]
+        for i, bound in enumerate(buckets):
+            if value <= bound: h[i] += 1
+        h[-2] += value
+        h[-1] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        t0 = time.perf_counter()
+        try: yield
+        finally: self.observe(name, time.perf_counter() - t0, **labels)
+
+    @staticmethod
+    def _labels(pairs):
+        if not pairs: return ""
+        esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+
+    def render(self):
+        lines = []
+        for name in sorted(set(self._series) | set(self._gauges)):
+            kind, help, buckets = self._meta.get(name, ("counter", name, LATENCY_BUCKETS))
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            if name in self._gauges:
+                try: lines.append(f"{name} {float(self._gauges[name]())}")
+                except Exception: pass
+                continue
+            for key, value in sorted(self._series[name].items()):
+                if kind != "histogram":
+                    lines.append(f"{name}{self._labels(key)} {value}")
+                    continue
+                for bound, count in zip(buckets, value):
+                    lines.append(f"{name}_bucket{self._labels(key + (('le', bound),))} {count}")
+                lines.append(f"{name}_bucket{self._labels(key + (('le', '+Inf'),))} {value[-1]}")
+                lines.append(f"{name}_sum{self._labels(key)} {value[-2]}")
+                lines.append(f"{name}_count{self._labels(key)} {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe("topbot_command_seconds", "histogram", "Slash command latency (đến khi trả lời xong)")
+metrics.describe("topbot_discord_requests_total", "counter", "Discord REST calls theo route và kết quả")
+metrics.describe("topbot_discord_ratelimited_total", "counter", "Số lần Discord trả 429 theo route")
+metrics.describe("topbot_board_update_seconds", "histogram", "Thời gian một lần update_board")
+metrics.describe("topbot_board_api_calls", "histogram", "Số API call của một lần update_board", CALL_BUCKETS)
+metrics.describe("topbot_render_seconds", "histogram", "Thời gian render ảnh tổng hợp trong worker pool")
+metrics.describe("topbot_store_flush_seconds", "histogram", "Thời gian ghi topplayers_data.json")
+
+RATE_LIMIT_ID_RE = re.compile(r"\d{15,}")
+
+class RateLimitLogHandler(logging.Handler):
+    """discord.py tự chờ khi bị 429 và chỉ báo qua log của discord.http -> đếm từ log."""
+    def emit(self, record):
+        msg = record.msg if isinstance(record.msg, str) else ""
+        if msg.startswith("We are being rate limited") and len(record.args or ()) >= 2:
+            method, url = record.args[0], str(record.args[1])
+            path = re.sub(r"^https?://[^/]+/api/v\d+", "", url)
+            metrics.inc("topbot_discord_ratelimited_total", route=f"{method} {RATE_LIMIT_ID_RE.sub('{id}', path)}", scope="route")
+        elif msg.startswith("Global rate limit"):
+            metrics.inc("topbot_discord_ratelimited_total", route="*", scope="global")
+
+logging.getLogger("discord.http").addHandler(RateLimitLogHandler(level=logging.WARNING))
+
+def instrument_http(http):
+    """Bọc HTTPClient.request để đếm mọi REST call theo route (path template, không có ID)."""
+    original = http.request
+    async def request(route, **kwargs):
+        key = f"{route.method} {route.path}"
+        try: result = await original(route, **kwargs)
+        except discord.HTTPException as e:
+            metrics.inc("topbot_discord_requests_total", route=key, status=str(e.status))
+            raise
+        except Exception:
+            metrics.inc("topbot_discord_requests_total", route=key, status="error")
+            raise
+        metrics.inc("topbot_discord_requests_total", route=key, status="ok")
+        return result
+    http.request = request
+
 # --- 3. JSON HELPERS ---
+FLUSH_DELAY = 2.0  # giây: gom nhiều lần ghi liên tiếp thành một lần ghi file
+
+def _atomic_write(filename, text):
+    """Ghi ra file tạm rồi rename, crash giữa chừng không làm hỏng file cũ."""
+    tmp = f"{filename}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
+
 def load_json(filename):
     if os.path.exists(filename):
         with open(filename, "r", encoding="utf-8") as f:
@@ -66,139 +254,854 @@ def load_json(filename):
     return {}
 
 def save_json(filename, data):
-    with open(filename, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=4)
+    _atomic_write(filename, json.dumps(data, indent=4))
+
+class PlayerRecord:
+    """Một dòng trên board. Rank là int; (msg_id, slot) là message chứa embed và vị trí embed trong đó, không đi theo người chơi."""
+    __slots__ = ("rank", "username", "mention_id", "displayname", "stage", "roblox_id", "country", "avatar_url", "avatar_at", "msg_id", "slot")
+    PROFILE = ("username", "mention_id", "displayname", "stage", "roblox_id", "country", "avatar_url", "avatar_at")
+
+    def __init__(self, rank, username="", mention_id=0, displayname="", stage="legend", roblox_id="0", country="Unknown", avatar_url="", avatar_at=0, msg_id=None, slot=None):
+        self.rank = int(rank)
+        self.username = username
+        self.mention_id = mention_id
+        self.displayname = displayname
+        self.stage = stage
+        self.roblox_id = roblox_id
+        self.country = country
+        self.avatar_url = avatar_url
+        self.avatar_at = avatar_at
+        self.msg_id = msg_id
+        self.slot = slot
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d["top"], d.get("username", ""), d.get("mention_id", 0), d.get("displayname", ""), d.get("stage", "legend"),
+                   d.get("roblox_id", "0"), d.get("country", "Unknown"), d.get("avatar_url", ""), d.get("avatar_at", 0), d.get("msg_id"), d.get("slot"))
+
+    def to_dict(self):
+        # Giữ nguyên định dạng file cũ: "top" là chuỗi
+        d = {"top": str(self.rank)}
+        for k in self.PROFILE:
+            if k == "avatar_at" and not self.avatar_at: continue
+            d[k] = getattr(self, k)
+        if self.msg_id is not None: d["msg_id"] = self.msg_id
+        if self.slot is not None: d["slot"] = self.slot
+        return d
+
+    def profile(self):
+        return tuple(getattr(self, k) for k in self.PROFILE)
+
+    def set_profile(self, values):
+        for k, v in zip(self.PROFILE, values): setattr(self, k, v)
+
+class RankTable:
+    """
+    Board của một kênh, luôn sắp theo rank (int). Có index theo rank, mention_id và roblox_id.
+    Các thao tác insert/remove/move/swap/bulk_reorder trả về danh sách rank bị thay đổi.
+    """
+    __slots__ = ("_ranks", "_by_rank", "_by_mention", "_by_roblox")
+
+    def __init__(self, records=()):
+        self._ranks = []       # rank đã sắp xếp (bisect)
+        self._by_rank = {}     # rank -> PlayerRecord
+        self._by_mention = {}  # mention_id -> set(rank)
+        self._by_roblox = {}   # roblox_id -> set(rank)
+        for rec in records: self.insert(rec)
+
+    @classmethod
+    def from_dicts(cls, rows):
+        return cls(PlayerRecord.from_dict(r) for r in rows)
+
+    def to_dicts(self):
+        return [rec.to_dict() for rec in self]
+
+    def __len__(self): return len(self._ranks)
+    def __bool__(self): return bool(self._ranks)
+    def __iter__(self): return (self._by_rank[r] for r in self._ranks)
+    def __contains__(self, rank): return int(rank) in self._by_rank
+
+    def get(self, rank):
+        return self._by_rank.get(int(rank))
+
+    def by_mention(self, mention_id):
+        return [self._by_rank[r] for r in sorted(self._by_mention.get(mention_id, ()))]
+
+    def by_roblox(self, roblox_id):
+        return [self._by_rank[r] for r in sorted(self._by_roblox.get(str(roblox_id), ()))]
+
+    def top(self, n):
+        return [self._by_rank[r] for r in self._ranks[:n]]
+
+    def _index(self, rec):
+        self._by_mention.setdefault(rec.mention_id, set()).add(rec.rank)
+        self._by_roblox.setdefault(str(rec.roblox_id), set()).add(rec.rank)
+
+    def _unindex(self, rec):
+        for idx, key in ((self._by_mention, rec.mention_id), (self._by_roblox, str(rec.roblox_id))):
+            ranks = idx.get(key)
+            if ranks:
+                ranks.discard(rec.rank)
+                if not ranks: del idx[key]
+
+    def update(self, rank, **fields):
+        """Sửa profile của một rank, giữ index đồng bộ."""
+        rec = self._by_rank.get(int(rank))
+        if rec is None: return []
+        self._unindex(rec)
+        for k, v in fields.items(): setattr(rec, k, v)
+        self._index(rec)
+        return [rec.rank]
+
+    def insert(self, rec):
+        """Thêm record; nếu rank đã có thì thay profile (giữ msg_id của vị trí đó)."""
+        old = self._by_rank.get(rec.rank)
+        if old is not None:
+            self._unindex(old)
+            if rec.msg_id is None: rec.msg_id, rec.slot = old.msg_id, old.slot
+        else:
+            bisect.insort(self._ranks, rec.rank)
+        self._by_rank[rec.rank] = rec
+        self._index(rec)
+        return [rec.rank]
+
+    def remove(self, rank):
+        rec = self._by_rank.pop(int(rank), None)
+        if rec is None: return []
+        del self._ranks[bisect.bisect_left(self._ranks, rec.rank)]
+        self._unindex(rec)
+        return [rec.rank]
+
+    def _rotate(self, ranks, profiles):
+        changed = []
+        for r, prof in zip(ranks, profiles):
+            rec = self._by_rank[r]
+            if rec.profile() == prof: continue
+            self._unindex(rec)
+            rec.set_profile(prof)
+            self._index(rec)
+            changed.append(r)
+        return changed
+
+    def move(self, src, dst):
+        """Đưa người ở rank src tới rank dst, các rank ở giữa dồn lên/xuống một bậc."""
+        src, dst = int(src), int(dst)
+        if src not in self._by_rank or dst not in self._by_rank: return None
+        i, j = bisect.bisect_left(self._ranks, src), bisect.bisect_left(self._ranks, dst)
+        lo, hi = min(i, j), max(i, j)
+        ranks = self._ranks[lo:hi + 1]
+        profiles = [self._by_rank[r].profile() for r in ranks]
+        profiles = profiles[-1:] + profiles[:-1] if i > j else profiles[1:] + profiles[:1]
+        return self._rotate(ranks, profiles)
+
+    def swap(self, r1, r2):
+        r1, r2 = int(r1), int(r2)
+        if r1 not in self._by_rank or r2 not in self._by_rank: return None
+        p1, p2 = self._by_rank[r1].profile(), self._by_rank[r2].profile()
+        return self._rotate([r1, r2], [p2, p1])
+
+    def bulk_reorder(self, order):
+        """order: các rank hiện có theo thứ tự mới; người ở order[k] chuyển tới vị trí k của các rank đó (sắp tăng dần)."""
+        order = [int(r) for r in order]
+        if len(set(order)) != len(order) or any(r not in self._by_rank for r in order): return None
+        slots = sorted(order)
+        profiles = [self._by_rank[r].profile() for r in order]
+        return self._rotate(slots, profiles)
+
+def new_channel_entry():
+    return {"players": RankTable(), "img_msg_id": None}
+
+def _encode_extra(obj):
+    if isinstance(obj, RankTable): return obj.to_dicts()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+class LeaderboardStore:
+    """
+    Dữ liệu leaderboard nằm thường trực trong RAM (load một lần khi khởi động).
+    Các lệnh chỉ đánh dấu kênh đã thay đổi, việc ghi file chạy nền:
+    nhiều lần mark_dirty trong FLUSH_DELAY giây chỉ tốn một lần ghi.
+    """
+    def __init__(self, filename, delay=FLUSH_DELAY):
+        self.filename = filename
+        self.delay = delay
+        self.data = load_json(filename)
+        for entry in self.data.values():
+            entry["players"] = RankTable.from_dicts(entry.get("players", []))
+        self._chunks = {}  # cid -> JSON đã encode của kênh đó (chỉ encode lại kênh bị dirty)
+        self._dirty = set()
+        self._task = None
+        self._lock = asyncio.Lock()
+        self.versions = {}  # cid -> số lần thay đổi, dùng làm khóa cache cho board API
+
+    def mark_dirty(self, cid):
+        self._dirty.add(cid)
+        self.versions[cid] = self.versions.get(cid, 0) + 1
+        if self._task is None or self._task.done():
+            try: self._task = asyncio.get_running_loop().create_task(self._flush_later())
+            except RuntimeError: self.flush_sync()
+
+    async def _flush_later(self):
+        # Lặp tới khi hết dirty: mark_dirty đến lúc đang ghi thấy task còn chạy nên không tạo task mới
+        while self._dirty:
+            await asyncio.sleep(self.delay)
+            try: await self.flush()
+            except OSError as e: print(f"⚠️ Không ghi được {self.filename}, sẽ thử lại: {e}")
+
+    def _encode(self):
+        """(các kênh dirty đã encode, JSON giống hệt json.dumps(self.data, indent=4))."""
+        dirty, self._dirty = self._dirty, set()
+        for cid in list(self._chunks):
+            if cid in dirty or cid not in self.data: del self._chunks[cid]
+        for cid in self.data:
+            if cid not in self._chunks:
+                self._chunks[cid] = json.dumps(self.data[cid], indent=4, default=_encode_extra).replace("\n", "\n    ")
+        if not self.data: return dirty, "{}"
+        body = ",\n".join(f"    {json.dumps(cid)}: {self._chunks[cid]}" for cid in self.data)
+        return dirty, "{\n" + body + "\n}"
+
+    async def flush(self):
+        if not self._dirty: return
+        async with self._lock:
+            if not self._dirty: return
+            with metrics.timer("topbot_store_flush_seconds"):
+                dirty, text = self._encode()
+                try: await asyncio.to_thread(_atomic_write, self.filename, text)
+                except OSError:
+                    self._dirty |= dirty  # ghi lỗi: giữ các kênh này lại cho lần flush sau
+                    raise
+
+    def flush_sync(self):
+        if not self._dirty: return
+        with metrics.timer("topbot_store_flush_seconds"):
+            dirty, text = self._encode()
+            try: _atomic_write(self.filename, text)
+            except OSError:
+                self._dirty |= dirty
+                raise
+
+store = LeaderboardStore(DATA_FILE)
+
+# --- 3b. PERMISSION INDEX ---
+RELOAD_CHECK_INTERVAL = 5.0  # giây giữa hai lần stat() file quyền để phát hiện sửa tay
+
+class PermissionIndex:
+    """
+    Index quyền thường trực trong RAM: set user ID / role ID theo guild và blacklist.
+    Các lệnh permissions/removeperm/blacklist cập nhật trực tiếp; file bị sửa ngoài bot thì tự reload.
+    """
+    def __init__(self, auth_file, blacklist_file):
+        self.auth_file = auth_file
+        self.blacklist_file = blacklist_file
+        self.auth = {}
+        self.blacklist = {}
+        self.users = {}  # gid -> set(user_id)
+        self.roles = {}  # gid -> set(role_id)
+        self._mtimes = {}
+        self._checked = 0.0
+        self.reload()
+
+    @staticmethod
+    def _mtime(filename):
+        try: return os.stat(filename).st_mtime_ns
+        except OSError: return None
+
+    def _index_auth(self):
+        self.users = {gid: set(v.get("users", [])) for gid, v in self.auth.items()}
+        self.roles = {gid: set(v.get("roles", [])) for gid, v in self.auth.items()}
+
+    def reload(self, auth=True, blacklist=True):
+        if auth:
+            self.auth = load_json(self.auth_file)
+            self._index_auth()
+            self._mtimes[self.auth_file] = self._mtime(self.auth_file)
+        if blacklist:
+            self.blacklist = load_json(self.blacklist_file)
+            self._mtimes[self.blacklist_file] = self._mtime(self.blacklist_file)
+        self._checked = time.monotonic()
+
+    def refresh(self):
+        now = time.monotonic()
+        if now - self._checked < RELOAD_CHECK_INTERVAL: return
+        self._checked = now
+        auth_changed = self._mtime(self.auth_file) != self._mtimes.get(self.auth_file)
+        bl_changed = self._mtime(self.blacklist_file) != self._mtimes.get(self.blacklist_file)
+        if auth_changed or bl_changed: self.reload(auth_changed, bl_changed)
+
+    def _save_auth(self):
+        save_json(self.auth_file, self.auth)
+        self._mtimes[self.auth_file] = self._mtime(self.auth_file)
+
+    def _save_blacklist(self):
+        save_json(self.blacklist_file, self.blacklist)
+        self._mtimes[self.blacklist_file] = self._mtime(self.blacklist_file)
+
+    def is_authorized(self, gid, user_id, role_ids):
+        self.refresh()
+        if user_id in self.users.get(gid, ()): return True
+        roles = self.roles.get(gid)
+        return bool(roles) and any(rid in roles for rid in role_ids)
+
+    def is_blacklisted(self, user_id):
+        self.refresh()
+        return str(user_id) in self.blacklist
+
+    def grant(self, gid, role_id=None, user_id=None):
+        entry = self.auth.setdefault(gid, {"roles": [], "users": []})
+        if role_id and role_id not in self.roles.setdefault(gid, set()):
+            entry.setdefault("roles", []).append(role_id); self.roles[gid].add(role_id)
+        if user_id and user_id not in self.users.setdefault(gid, set()):
+            entry.setdefault("users", []).append(user_id); self.users[gid].add(user_id)
+        self._save_auth()
+
+    def revoke(self, gid, role_id=None, user_id=None):
+        if gid not in self.auth: return
+        entry = self.auth[gid]
+        if role_id and role_id in self.roles.get(gid, ()):
+            entry["roles"].remove(role_id); self.roles[gid].discard(role_id)
+        if user_id and user_id in self.users.get(gid, ()):
+            entry["users"].remove(user_id); self.users[gid].discard(user_id)
+        self._save_auth()
+
+    def ban(self, user_id, reason, by):
+        self.blacklist[str(user_id)] = {"reason": reason, "by": by}
+        self._save_blacklist()
+
+    def unban(self, user_id):
+        self.blacklist.pop(str(user_id), None)
+        self._save_blacklist()
+
+perms = PermissionIndex(AUTH_FILE, BLACKLIST_FILE)
 
 def is_authorized(interaction: discord.Interaction):
     if interaction.user.id == BOT_OWNER_ID: return True
-    auth = load_json(AUTH_FILE)
-    gid = str(interaction.guild_id)
-    if gid in auth:
-        if interaction.user.id in auth[gid].get("users", []): return True
-        u_roles = [r.id for r in interaction.user.roles]
-        for rid in auth[gid].get("roles", []):
-            if rid in u_roles: return True
-    return False
+    return perms.is_authorized(str(interaction.guild_id), interaction.user.id, (r.id for r in getattr(interaction.user, "roles", ())))
 
 def is_blacklisted(user_id):
-    blacklist = load_json(BLACKLIST_FILE)
-    return str(user_id) in blacklist
+    return perms.is_blacklisted(user_id)
 
 # --- 4. DATA SYNCING (Hàm quan trọng: Tự động hồi phục dữ liệu) ---
+RECOVERY_GAP = 200       # đã thấy board mà thêm chừng này message không có embed rank -> dừng quét
+WARM_CONCURRENCY = 4     # số kênh quét song song lúc khởi động
+
+RANK_RE = re.compile(r"Rank (\d+)")
+MENTION_RE = re.compile(r"<@!?(\d+)>")
+COUNTRY_RE = re.compile(r"Country: ([^\n]+)")
+RID_RE = re.compile(r"RID:(\d+)")
+STG_RE = re.compile(r"STG:(\w+)")
+USERNAME_PREFIX, USERNAME_SUFFIX = "`⋆. 𐙚˚࿔ ", " 𝜗𝜚˚⋆`"
+
+def parse_rank_embed(emb, msg_id, slot=0):
+    """Đọc ngược một embed do get_embed tạo ra thành PlayerRecord, None nếu không phải embed rank."""
+    if not emb.title or "Rank" not in emb.title: return None
+    rank_match = RANK_RE.search(emb.title)
+    if not rank_match: return None
+    try:
+        dname = emb.title.split(" - ", 1)[1].strip()
+        uname = (emb.description or "").removeprefix(USERNAME_PREFIX).removesuffix(USERNAME_SUFFIX).strip()
+        info = emb.fields[0].value if emb.fields else ""
+        m_id_match = MENTION_RE.search(info)
+        ctry_match = COUNTRY_RE.search(info)
+        footer = emb.footer.text or ""
+        rid_match = RID_RE.search(footer)
+        stg_match = STG_RE.search(footer)
+    except (IndexError, AttributeError): return None
+    return PlayerRecord(
+        rank_match.group(1), username=uname,
+        mention_id=int(m_id_match.group(1)) if m_id_match else 0,
+        displayname=dname,
+        stage=stg_match.group(1) if stg_match else "legend",
+        roblox_id=rid_match.group(1) if rid_match else "0",
+        country=ctry_match.group(1).strip() if ctry_match else "Unknown",
+        avatar_url=emb.thumbnail.url, msg_id=msg_id, slot=slot
+    )
+
+async def scan_history(channel, after=None):
+    """
+    Quét lịch sử kênh (tự phân trang) để tìm embed rank của bot.
+    Không có checkpoint: đi từ mới -> cũ, dừng khi đã đủ rank 1..max hoặc qua RECOVERY_GAP message không liên quan.
+    Có checkpoint: chỉ đọc các message mới hơn nó.
+    Trả về ({rank: player}, id message mới nhất đã đọc, {msg_id: page_digest} các trang board đã đọc,
+    id message ảnh tổng hợp mới nhất hoặc None).
+    """
+    found, newest, gap = {}, None, 0
+    pages, image = {}, None
+    history = channel.history(limit=None, after=after, oldest_first=after is not None)
+    async for message in history:
+        newest = max(newest or 0, message.id)
+        parsed = []
+        if message.author == bot.user:
+            if any(a.filename.startswith("top_summary.") for a in message.attachments):
+                image = max(image or 0, message.id)
+            if message.embeds:
+                # Mỗi message của board chứa tối đa 10 embed rank
+                parsed = [p for p in (parse_rank_embed(e, message.id, i) for i, e in enumerate(message.embeds)) if p]
+        if parsed: pages[message.id] = page_digest(message.embeds)
+        if not parsed:
+            gap += 1
+            if after is None and found and gap >= RECOVERY_GAP: break
+            continue
+        gap = 0
+        for p in parsed:
+            if after is not None or p.rank not in found:
+                found[p.rank] = p  # rank trùng: giữ message mới nhất
+        if after is None and 1 in found and len(found) == max(found): break
+    return found, newest, pages, image
+
+async def recover_channel(channel, cid, data, full=False):
+    """Hồi phục/gộp dữ liệu của kênh từ lịch sử tin nhắn. Trả về True nếu dữ liệu thay đổi."""
+    if cid not in data: data[cid] = new_channel_entry()
+    entry = data[cid]
+    checkpoint = None if full else entry.get("scan_checkpoint")
+    found, newest, pages, image = await scan_history(channel, discord.Object(id=checkpoint) if checkpoint else None)
+    if newest and newest > (entry.get("scan_checkpoint") or 0): entry["scan_checkpoint"] = newest
+
+    changed = False
+    table = entry["players"]
+    for rank, p in found.items():
+        old = table.get(rank)
+        if old is None or p.msg_id > (old.msg_id or 0):
+            if old is not None and old.avatar_url == p.avatar_url: p.avatar_at = old.avatar_at
+            table.insert(p)
+            changed = True
+    if changed:
+        # Dựng lại slot từ msg_id; hash lấy từ nội dung vừa quét nên trang không đổi sẽ không bị edit lại
+        known = {s["msg_id"]: s["hash"] for s in entry.get("board", ())}
+        ids = sorted({p.msg_id for p in table if p.msg_id})
+        entry["board"] = [{"msg_id": mid, "hash": pages.get(mid, known.get(mid))} for mid in ids]
+    if image and image > (entry.get("img_msg_id") or 0):
+        # Ảnh luôn được gửi lại sau mỗi lần top 10 đổi -> coi ảnh mới nhất khớp top 10 vừa khôi phục
+        entry["img_msg_id"] = image
+        entry["img_hash"] = summary_digest(table.top(10))
+    if changed or newest: store.mark_dirty(cid)
+    return changed
+
 async def ensure_data_sync(interaction: discord.Interaction, data, cid):
     """
     Kiểm tra nếu dữ liệu trống thì tự động quét kênh để lấy lại.
     Trả về True nếu đã sync, False nếu không tìm thấy gì.
     """
-    if cid not in data or not data[cid].get("players"):
-        if cid not in data: data[cid] = {"players": [], "img_msg_id": None}
-        
-        scanned_players = []
-        # Quét 50 tin nhắn gần nhất
-        async for message in interaction.channel.history(limit=50):
-            if message.author == bot.user and message.embeds:
-                emb = message.embeds[0]
-                if emb.title and "Rank" in emb.title:
-                    try:
-                        rank_match = re.search(r"Rank (\d+)", emb.title)
-                        if not rank_match: continue
-                        
-                        rank = rank_match.group(1)
-                        dname = emb.title.split(" - ")[1].strip()
-                        uname = emb.description.replace("`⋆. 𐙚˚࿔ ", "").replace(" 𝜗𝜚˚⋆`", "").strip()
-                        
-                        # Regex an toàn hơn cho các trường
-                        m_id_match = re.search(r"<@(\d+)>", emb.fields[0].value)
-                        ctry_match = re.search(r"Country: (.+)", emb.fields[0].value)
-                        
-                        m_id = int(m_id_match.group(1)) if m_id_match else 0
-                        ctry = ctry_match.group(1).split('\n')[0].strip() if ctry_match else "Unknown"
-
-                        # Lấy metadata ẩn
-                        rid = "0"
-                        stg = "legend"
-                        if emb.footer.text:
-                            rid_match = re.search(r"RID:(\d+)", emb.footer.text)
-                            stg_match = re.search(r"STG:(\w+)", emb.footer.text)
-                            if rid_match: rid = rid_match.group(1)
-                            if stg_match: stg = stg_match.group(1)
-
-                        scanned_players.append({
-                            "top": rank, "username": uname, "mention_id": m_id,
-                            "displayname": dname, "stage": stg, "roblox_id": rid,
-                            "country": ctry, "avatar_url": emb.thumbnail.url,
-                            "msg_id": message.id
-                        })
-                    except: continue
-        
-        if scanned_players:
-            data[cid]["players"] = scanned_players
-            save_json(DATA_FILE, data)
-            return True
-    return False
+    if cid in data and data[cid].get("players"): return False
+    return await recover_channel(interaction.channel, cid, data)
+
+async def warm_channels(data):
+    """Lúc khởi động: quét trước mọi kênh leaderboard đã biết (song song) để lệnh đầu tiên không phải chờ."""
+    limit = asyncio.Semaphore(WARM_CONCURRENCY)
+    async def warm(cid):
+        channel = bot.get_channel(int(cid))
+        if channel is None: return
+        async with limit:
+            try: await recover_channel(channel, cid, data)
+            except discord.HTTPException as e: print(f"⚠️ Không quét được kênh {cid}: {e}")
+    await asyncio.gather(*(warm(cid) for cid in list(data)))
 
 # --- 5. ROLE MANAGEMENT ---
-async def manage_roles(guild, member_id, new_stage):
-    """Xóa role rank cũ và thêm role rank mới"""
-    if not guild: return
-    member = guild.get_member(member_id)
-    if not member: return
+ROLE_SYNC_WORKERS = 3  # số member được cập nhật role song song khi /topplayer syncroles
+MEMBER_CACHE_TTL = 300  # giây giữ member đã fetch khi không có cache member của gateway
+MEMBER_CACHE_MAX = 2000
 
-    # Tìm các role rank trong server
-    target_role_name = RANK_ROLES.get(new_stage)
-    roles_to_remove = []
-    role_to_add = None
+class MemberLookup:
+    """
+    guild.get_member, nếu không có (gateway gọn) thì fetch_member và giữ kết quả MEMBER_CACHE_TTL giây.
+    Cache chỉ dùng cho việc đọc (tên, có còn trong server không): gateway gọn không gửi update member
+    nên role trong cache có thể đã cũ -> mọi lần ghi role phải lấy member với fresh=True.
+    """
+    def __init__(self, ttl=MEMBER_CACHE_TTL, max_items=MEMBER_CACHE_MAX):
+        self.ttl = ttl
+        self.max_items = max_items
+        self._cache = OrderedDict()  # (guild_id, member_id) -> (hết hạn lúc, Member | None)
 
-    for role in guild.roles:
-        if role.name == target_role_name:
-            role_to_add = role
-        elif role.name in RANK_ROLES.values():
-            roles_to_remove.append(role)
-    
+    async def get(self, guild, member_id, fresh=False):
+        member = guild.get_member(member_id)
+        if member: return member
+        key = (guild.id, member_id)
+        hit = None if fresh else self._cache.get(key)
+        if hit and hit[0] > time.monotonic(): return hit[1]
+        try: member = await guild.fetch_member(member_id)
+        except discord.NotFound: member = None
+        except discord.HTTPException: return None
+        self.remember(guild.id, member_id, member)
+        return member
+
+    def remember(self, guild_id, member_id, member):
+        key = (guild_id, member_id)
+        self._cache.pop(key, None)
+        self._cache[key] = (time.monotonic() + self.ttl, member)
+        if len(self._cache) > self.max_items: self._cache.popitem(last=False)
+
+members = MemberLookup()
+
+
+class RankRoleCache:
+    """
+    Role ID của các role rank theo từng guild, chỉ dò guild.roles một lần.
+    Bị xóa khi có event tạo/sửa/xóa role trong guild đó.
+    """
+    def __init__(self):
+        self._guilds = {}  # guild_id -> ({stage: role_id}, set(mọi role_id rank))
+
+    def get(self, guild):
+        cached = self._guilds.get(guild.id)
+        if cached is None:
+            by_name = {name: stage for stage, name in RANK_ROLES.items()}
+            targets, all_ids = {}, set()
+            for role in guild.roles:
+                stage = by_name.get(role.name)
+                if stage:
+                    targets[stage] = role.id
+                    all_ids.add(role.id)
+            cached = self._guilds[guild.id] = (targets, all_ids)
+        return cached
+
+    def invalidate(self, guild_id):
+        self._guilds.pop(guild_id, None)
+
+rank_roles = RankRoleCache()
+
+def desired_roles(member, stage):
+    """Danh sách role mới của member (bỏ mọi role rank, thêm role của stage), None nếu không cần đổi."""
+    targets, all_ids = rank_roles.get(member.guild)
+    current = [r for r in member.roles if not r.is_default()]
+    new = [r for r in current if r.id not in all_ids]
+    target = member.guild.get_role(targets[stage]) if stage in targets else None
+    if target: new.append(target)
+    if {r.id for r in new} == {r.id for r in current}: return None
+    return new
+
+async def apply_rank_role(member, stage):
+    """
+    Một lần PATCH member thay cho remove_roles + add_roles. Trả về True nếu đã đổi role.
+    PATCH thay toàn bộ role nên member phải vừa lấy mới (interaction hoặc fetch), không dùng bản trong cache.
+    """
+    roles = desired_roles(member, stage)
+    if roles is None: return False
     try:
-        if roles_to_remove:
-            await member.remove_roles(*roles_to_remove, reason="Leaderboard Rank Update")
-        if role_to_add:
-            await member.add_roles(role_to_add, reason="Leaderboard Rank Update")
-    except:
+        await member.edit(roles=roles, reason="Leaderboard Rank Update")
+        return True
+    except discord.HTTPException:
         print(f"⚠️ Không thể cập nhật Role cho {member.display_name}. Kiểm tra quyền Bot.")
+        return False
+
+async def manage_roles(guild, member, new_stage):
+    """Xóa role rank cũ và thêm role rank mới. member: Member vừa resolve từ interaction, hoặc ID để fetch mới."""
+    if not guild: return
+    if not isinstance(member, discord.Member): member = await members.get(guild, member, fresh=True)
+    if not member: return
+    await apply_rank_role(member, new_stage)
+
+async def sync_board_roles(guild, table):
+    """
+    Đối chiếu role rank của mọi người trên board với stage mong muốn (theo rank cao nhất của họ),
+    chỉ gửi thay đổi cần thiết qua một hàng đợi có giới hạn song song.
+    Trả về (số member đã đổi, số member giữ nguyên, số member không tìm thấy).
+    """
+    queue = asyncio.Queue()
+    seen = set()
+    for p in table:
+        if p.mention_id and p.mention_id not in seen:
+            seen.add(p.mention_id)
+            queue.put_nowait((p.mention_id, p.stage))
+
+    updated = unchanged = missing = 0
+    async def worker():
+        nonlocal updated, unchanged, missing
+        while True:
+            try: mid, stage = queue.get_nowait()
+            except asyncio.QueueEmpty: return
+            member = await members.get(guild, mid, fresh=True)
+            if member is None: missing += 1
+            elif desired_roles(member, stage) is None: unchanged += 1
+            elif await apply_rank_role(member, stage): updated += 1
+    await asyncio.gather(*(worker() for _ in range(ROLE_SYNC_WORKERS)))
+    return updated, unchanged, missing
 
 # --- 6. IMAGE GENERATION ---
-async def create_top_player_image(players):
-    canvas_w, canvas_h = 1100, 750
-    bg = Image.new('RGB', (canvas_w, canvas_h), (0, 0, 0))
-    async with aiohttp.ClientSession() as session:
+@functools.lru_cache(maxsize=None)
+def pil():
+    """Pillow chỉ được import khi lần đầu cần decode/render ảnh, giúp bot khởi động nhanh hơn."""
+    from PIL import Image, ImageDraw, ImageFont
+    return Image, ImageDraw, ImageFont
+
+ASSET_CACHE_DIR = "asset_cache"
+ASSET_TTL = 6 * 3600                       # giây trước khi revalidate với CDN
+ASSET_CACHE_MAX_BYTES = 50 * 1024 * 1024   # dung lượng tối đa của cache trên đĩa
+ASSET_MEMORY_ITEMS = 256                   # số Image đã decode giữ trong RAM
+AVATAR_CONCURRENCY = 5                     # số avatar tải song song cho một ảnh
+
+class AssetCache:
+    """
+    Cache 2 tầng cho logo/avatar:
+    - Đĩa: bytes theo URL, hết TTL thì revalidate bằng ETag/Last-Modified,
+      vượt dung lượng thì xóa file cũ nhất. CDN lỗi/chậm thì dùng lại bản cũ.
+    - RAM: LRU bytes + LRU các Image đã decode + resize, key theo hash nội dung.
+    """
+    def __init__(self, directory, ttl=ASSET_TTL, max_bytes=ASSET_CACHE_MAX_BYTES, max_items=ASSET_MEMORY_ITEMS):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self._images = OrderedDict()  # (digest nội dung, size) -> Image
+        self._blobs = OrderedDict()   # digest nội dung -> bytes
+        self._fresh = {}              # url -> (hết hạn lúc, digest nội dung)
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _paths(self, url):
+        base = os.path.join(self.directory, hashlib.sha1(url.encode("utf-8")).hexdigest())
+        return base + ".bin", base + ".json"
+
+    def _read(self, url):
+        body, meta = self._paths(url)
         try:
-            async with session.get(SCP_LOGO_URL) as resp:
+            with open(meta, "r", encoding="utf-8") as f: m = json.load(f)
+            with open(body, "rb") as f: return f.read(), m
+        except (OSError, ValueError): return None, None
+
+    def _write(self, url, content, meta):
+        os.makedirs(self.directory, exist_ok=True)
+        body, meta_path = self._paths(url)
+        with open(body + ".tmp", "wb") as f: f.write(content)
+        os.replace(body + ".tmp", body)
+        _atomic_write(meta_path, json.dumps(meta))
+        self._evict()
+
+    def _write_meta(self, url, meta):
+        _atomic_write(self._paths(url)[1], json.dumps(meta))
+
+    def _evict(self):
+        entries, total = [], 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(".bin"): continue
+            st = os.stat(os.path.join(self.directory, name))
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes: break
+            base = os.path.join(self.directory, name[:-4])
+            for path in (base + ".bin", base + ".json"):
+                try: os.remove(path)
+                except OSError: pass
+            total -= size
+
+    async def fetch(self, session, url):
+        """Trả về bytes của URL (ưu tiên cache), None nếu chưa từng tải được."""
+        if not url: return None
+        content, meta = await asyncio.to_thread(self._read, url)
+        if content is not None and time.time() - meta.get("fetched_at", 0) < self.ttl:
+            return content
+        headers = {}
+        if content is not None:
+            if meta.get("etag"): headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"): headers["If-Modified-Since"] = meta["last_modified"]
+        try:
+            async with session.get(url, headers=headers) as resp:
+                if resp.status == 304 and content is not None:
+                    meta["fetched_at"] = time.time()
+                    await asyncio.to_thread(self._write_meta, url, meta)
+                    return content
                 if resp.status == 200:
-                    logo = Image.open(io.BytesIO(await resp.read())).convert("RGBA").resize((500, 500))
-                    alpha = logo.getchannel('A').point(lambda i: i * 0.15)
-                    logo.putalpha(alpha)
-                    bg.paste(logo, (canvas_w//2 - 250, canvas_h//2 - 220), logo)
-        except: pass
+                    content = await resp.read()
+                    meta = {"url": url, "etag": resp.headers.get("ETag"), "last_modified": resp.headers.get("Last-Modified"), "fetched_at": time.time()}
+                    await asyncio.to_thread(self._write, url, content, meta)
+        except (aiohttp.ClientError, asyncio.TimeoutError): pass
+        return content
 
-        draw = ImageDraw.Draw(bg)
-        try: font = ImageFont.truetype("arial.ttf", 45)
-        except: font = ImageFont.load_default()
-        
-        draw.text((canvas_w//2 - 250, 40), "TOP PLAYER SUMMARY", fill=(255, 255, 255), font=font)
-        
-        for i, p in enumerate(players[:10]):
-            row, col = i // 5, i % 5
-            x, y = 80 + (col * 200), 150 + (row * 280)
+    def decode(self, digest, content, size):
+        """Image đã decode + resize (LRU trong RAM). An toàn khi gọi từ nhiều thread render."""
+        key = (digest, size)
+        with self._lock:
+            img = self._images.get(key)
+            if img is not None:
+                self._images.move_to_end(key)
+                return img
+        img = pil()[0].open(io.BytesIO(content)).convert("RGBA").resize(size)
+        with self._lock:
+            self._images[key] = img
+            if len(self._images) > self.max_items: self._images.popitem(last=False)
+        return img
+
+    async def get(self, session, url):
+        """(digest, bytes) của URL; nếu còn hạn thì lấy thẳng từ RAM, không đụng tới đĩa/mạng."""
+        fresh = self._fresh.get(url)
+        if fresh and fresh[0] > time.time() and fresh[1] in self._blobs:
+            self.hits += 1
+            self._blobs.move_to_end(fresh[1])
+            return fresh[1], self._blobs[fresh[1]]
+        self.misses += 1
+        content = await self.fetch(session, url)
+        if content is None: return None
+        digest = hashlib.sha1(content).hexdigest()
+        self._fresh[url] = (time.time() + self.ttl, digest)
+        self._blobs[digest] = content
+        if len(self._blobs) > self.max_items: self._blobs.popitem(last=False)
+        return digest, content
+
+assets = AssetCache(ASSET_CACHE_DIR)
+metrics.gauge("topbot_avatar_cache_hits_total", lambda: assets.hits, "Avatar lấy thẳng từ RAM", kind="counter")
+metrics.gauge("topbot_avatar_cache_misses_total", lambda: assets.misses, "Avatar phải đọc đĩa/tải lại", kind="counter")
+
+THUMBNAIL_BATCH_WINDOW = 0.05   # giây gom các lookup đến gần nhau thành một request
+THUMBNAIL_BATCH_SIZE = 100      # số userIds tối đa mỗi request
+THUMBNAIL_TTL = 3600            # giây cache URL đã resolve theo roblox_id
+AVATAR_MAX_AGE = 7 * 86400      # URL 30DAY- của Roblox: coi là cũ sau 7 ngày
+
+class ThumbnailResolver:
+    """
+    Resolve roblox_id -> URL avatar headshot. Các lookup đến trong THUMBNAIL_BATCH_WINDOW
+    được gom thành một request `userIds=a,b,c`, kết quả cache theo roblox_id với TTL.
+    """
+    def __init__(self, api_url=THUMBNAIL_API, window=THUMBNAIL_BATCH_WINDOW, ttl=THUMBNAIL_TTL):
+        self.api_url = api_url
+        self.window = window
+        self.ttl = ttl
+        self.session = None  # None -> dùng bot.session
+        self.requests = 0
+        self._cache = {}     # roblox_id -> (hết hạn lúc, url)
+        self._pending = {}   # roblox_id -> Future
+        self._task = None
+
+    def cached(self, roblox_id):
+        hit = self._cache.get(str(roblox_id))
+        return hit[1] if hit and hit[0] > time.time() else None
+
+    async def resolve(self, roblox_id, refresh=False):
+        """URL avatar 150x150, "" nếu không lấy được."""
+        rid = str(roblox_id)
+        if not refresh:
+            url = self.cached(rid)
+            if url: return url
+        fut = self._pending.get(rid)
+        if fut is None:
+            loop = asyncio.get_running_loop()
+            fut = self._pending[rid] = loop.create_future()
+            if self._task is None or self._task.done():
+                self._task = loop.create_task(self._flush_later())
+        return await asyncio.shield(fut)
+
+    async def resolve_many(self, roblox_ids, refresh=False):
+        ids = list(dict.fromkeys(str(r) for r in roblox_ids))
+        urls = await asyncio.gather(*(self.resolve(rid, refresh) for rid in ids))
+        return dict(zip(ids, urls))
+
+    async def _flush_later(self):
+        # Lặp tới khi hết pending: lookup đến lúc đang gửi batch thấy task còn chạy nên không tạo task mới
+        while self._pending:
+            await asyncio.sleep(self.window)
+            pending, self._pending = self._pending, {}
+            ids = list(pending)
             try:
-                async with session.get(p['avatar_url']) as resp:
-                    if resp.status == 200:
-                        avatar = Image.open(io.BytesIO(await resp.read())).convert("RGBA").resize((150, 150))
-                        draw.rectangle([x-5, y-5, x+155, y+155], outline=(255, 255, 255), width=3)
-                        bg.paste(avatar, (x, y), avatar)
-                        draw.text((x + 30, y + 160), f"RANK {p['top']}", fill=(255, 255, 255))
-            except: continue
+                for i in range(0, len(ids), THUMBNAIL_BATCH_SIZE):
+                    chunk = ids[i:i + THUMBNAIL_BATCH_SIZE]
+                    try: found = await self._request(chunk)
+                    except Exception as e:
+                        print(f"⚠️ Thumbnail lookup failed: {e!r}")
+                        found = {}
+                    for rid in chunk:
+                        url = found.get(rid, "")
+                        if url: self._cache[rid] = (time.time() + self.ttl, url)
+                        if not pending[rid].done(): pending[rid].set_result(url)
+            finally:
+                # Không để lookup nào treo mãi, kể cả khi task bị hủy
+                for fut in pending.values():
+                    if not fut.done(): fut.set_result("")
+
+    async def _request(self, chunk):
+        params = {"userIds": ",".join(chunk), "size": "150x150", "format": "Png"}
+        self.requests += 1
+        try:
+            async with (self.session or bot.session).get(self.api_url, params=params) as r:
+                if r.status != 200: return {}
+                body = await r.json()
+            return {str(d["targetId"]): d["imageUrl"] for d in body.get("data", []) if d.get("imageUrl")}
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError, TypeError, AttributeError): return {}
+
+thumbnails = ThumbnailResolver()
+metrics.gauge("topbot_thumbnail_requests_total", lambda: thumbnails.requests, "Request batch tới Roblox thumbnails API", kind="counter")
+
+def avatar_is_stale(p):
+    return not p.avatar_url or time.time() - (p.avatar_at or 0) > AVATAR_MAX_AGE
+
+# Render chạy trong worker pool: input là dữ liệu thuần, output là bytes ảnh.
+# Tile = (rank, digest, bytes avatar) hoặc (rank, None, None) nếu không tải được avatar.
+CANVAS_SIZE = (1100, 750)
+RENDER_WORKERS = 2
+SUMMARY_FORMAT = os.getenv("SUMMARY_FORMAT", "png").lower()  # "png" (optimize) hoặc "webp"
+render_pool = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="render")
+_template = None
+_template_has_logo = False
+_template_lock = Lock()
+
+@functools.lru_cache(maxsize=None)
+def title_font():
+    ImageFont = pil()[2]
+    try: return ImageFont.truetype("arial.ttf", 45)
+    except: return ImageFont.load_default()
+
+def template_ready():
+    return _template is not None and _template_has_logo
+
+def get_template(logo=None):
+    """Nền đen + logo đã làm mờ + tiêu đề, dựng một lần rồi dùng lại cho mọi lần render."""
+    global _template, _template_has_logo
+    with _template_lock:
+        if _template is None or (logo and not _template_has_logo):
+            Image, ImageDraw, _ = pil()
+            canvas_w, canvas_h = CANVAS_SIZE
+            bg = Image.new('RGB', CANVAS_SIZE, (0, 0, 0))
+            if logo:
+                try:
+                    layer = Image.open(io.BytesIO(logo)).convert("RGBA").resize((500, 500))
+                    alpha = layer.getchannel('A').point(lambda i: i * 0.15)
+                    layer.putalpha(alpha)
+                    bg.paste(layer, (canvas_w//2 - 250, canvas_h//2 - 220), layer)
+                    _template_has_logo = True
+                except: pass
+            ImageDraw.Draw(bg).text((canvas_w//2 - 250, 40), "TOP PLAYER SUMMARY", fill=(255, 255, 255), font=title_font())
+            _template = bg
+        return _template
+
+def render_summary(tiles, logo=None, fmt=SUMMARY_FORMAT):
+    """Ghép tối đa 10 tile avatar lên template, trả về bytes PNG/WebP. Không đụng tới asyncio."""
+    bg = get_template(logo).copy()
+    draw = pil()[1].Draw(bg)
+    for i, (rank, digest, content) in enumerate(tiles[:10]):
+        if content is None: continue
+        row, col = i // 5, i % 5
+        x, y = 80 + (col * 200), 150 + (row * 280)
+        try: avatar = assets.decode(digest, content, (150, 150))
+        except: continue
+        draw.rectangle([x-5, y-5, x+155, y+155], outline=(255, 255, 255), width=3)
+        bg.paste(avatar, (x, y), avatar)
+        draw.text((x + 30, y + 160), f"RANK {rank}", fill=(255, 255, 255))
 
     img_bin = io.BytesIO()
-    bg.save(img_bin, format='PNG')
-    img_bin.seek(0)
-    return discord.File(fp=img_bin, filename="top_summary.png")
+    if fmt == "webp": bg.save(img_bin, format='WEBP', quality=90, method=4)
+    else: bg.save(img_bin, format='PNG', optimize=True)
+    return img_bin.getvalue()
+
+async def render_top_players(players, session=None):
+    """Ảnh tổng hợp top 10 dưới dạng (bytes, định dạng)."""
+    session = session or bot.session
+    logo = None if template_ready() else await assets.fetch(session, SCP_LOGO_URL)
+
+    # Tải avatar song song (giới hạn AVATAR_CONCURRENCY) thay vì lần lượt từng cái
+    limit = asyncio.Semaphore(AVATAR_CONCURRENCY)
+    async def load_avatar(p):
+        async with limit:
+            try: return await assets.get(session, p.avatar_url)
+            except: return None
+    top = players[:10]
+    avatars = await asyncio.gather(*(load_avatar(p) for p in top))
+    tiles = [(str(p.rank), *(a or (None, None))) for p, a in zip(top, avatars)]
+
+    fmt = "webp" if SUMMARY_FORMAT == "webp" else "png"
+    with metrics.timer("topbot_render_seconds"):
+        data = await asyncio.get_running_loop().run_in_executor(render_pool, render_summary, tiles, logo, fmt)
+    return data, fmt
+
+async def create_top_player_image(players, session=None):
+    data, fmt = await render_top_players(players, session)
+    return discord.File(fp=io.BytesIO(data), filename=f"top_summary.{fmt}")
 
 # --- 7. EMBED & BOARD LOGIC ---
 def get_embed(p):
@@ -210,63 +1113,452 @@ def get_embed(p):
         "semi": "<:Semi:1468846825623523370>"
     }
     
-    stg_type = p.get('stage', 'legend').lower()
+    stg_type = (p.stage or 'legend').lower()
     stg_icon = emojis.get(stg_type, emojis['legend'])
     
-    embed = discord.Embed(title=f"Rank {p['top']} - {p['displayname']}", color=0x000000)
-    embed.description = f"`⋆. 𐙚˚࿔ {p['username']} 𝜗𝜚˚⋆`"
-    embed.add_field(name="════════ Information ════════", value=f"༒︎ Country: {p['country']}\n༒︎ Stage: {stg_icon}\n༒︎ Mention: <@{p['mention_id']}>", inline=False)
-    embed.set_thumbnail(url=p['avatar_url'])
+    embed = discord.Embed(title=f"Rank {p.rank} - {p.displayname}", color=0x000000)
+    embed.description = f"`⋆. 𐙚˚࿔ {p.username} 𝜗𝜚˚⋆`"
+    embed.add_field(name="════════ Information ════════", value=f"༒︎ Country: {p.country}\n༒︎ Stage: {stg_icon}\n༒︎ Mention: <@{p.mention_id}>", inline=False)
+    embed.set_thumbnail(url=p.avatar_url)
     embed.set_image(url=DECORATION_GIF)
-    embed.set_footer(text=f"RID:{p['roblox_id']} | STG:{stg_type}")
+    embed.set_footer(text=f"RID:{p.roblox_id} | STG:{stg_type}")
     return embed
 
-async def update_board(channel, cid, data, edit_mode=False):
-    players = data[cid]["players"]
-    players.sort(key=lambda x: int(x['top']))
+EDIT_CONCURRENCY = int(os.getenv("EDIT_CONCURRENCY", 5))  # số message edit song song trong edit_mode
+
+EMBEDS_PER_MESSAGE = 10   # Discord cho tối đa 10 embed mỗi message
+EMBED_CHARS_PER_MESSAGE = 6000  # và tổng số ký tự các embed trong một message không quá 6000
+
+def _embed_content(e):
+    # Chỉ các trường bot tự đặt: embed Discord trả về (khi quét lịch sử) có thêm type, proxy_url, width/height...
+    d = e.to_dict()
+    return [d.get("title"), d.get("description"), d.get("color") or 0,
+            [[f.get("name"), f.get("value"), bool(f.get("inline"))] for f in d.get("fields", [])],
+            d.get("thumbnail", {}).get("url"), d.get("image", {}).get("url"), d.get("footer", {}).get("text")]
+
+def page_digest(embeds):
+    """Hash nội dung các embed của một message, dùng để biết message nào thực sự cần edit."""
+    raw = json.dumps([_embed_content(e) for e in embeds], ensure_ascii=False)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+def summary_digest(players):
+    """Ảnh tổng hợp chỉ phụ thuộc vào rank + avatar của 10 người đầu."""
+    raw = json.dumps([(p.rank, p.avatar_url or "") for p in players[:10]])
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+def paginate(players):
+    """Gom player theo thứ tự rank thành các trang [(player, embed)], tối đa 10 embed / 6000 ký tự mỗi trang."""
+    pages, page, size = [], [], 0
+    for p in players:
+        emb = get_embed(p)
+        n = len(emb)
+        if page and (len(page) >= EMBEDS_PER_MESSAGE or size + n > EMBED_CHARS_PER_MESSAGE):
+            pages.append(page)
+            page, size = [], 0
+        page.append((p, emb))
+        size += n
+    if page: pages.append(page)
+    return pages
+
+def assign_page(page, msg_id):
+    for slot, (p, _) in enumerate(page):
+        p.msg_id, p.slot = msg_id, slot
+
+def board_slots(entry):
+    """Danh sách message của board theo thứ tự trong kênh: [{"msg_id", "hash"}], mỗi message chứa một trang."""
+    if "board" not in entry:
+        # Dữ liệu cũ chưa có "board": dựng lại từ msg_id của player, hash chưa biết
+        ids = sorted({p.msg_id for p in entry.get("players", ()) if p.msg_id})
+        entry["board"] = [{"msg_id": mid, "hash": None} for mid in ids]
+    return entry["board"]
+
+async def send_summary(channel, entry, players):
+    """Xóa ảnh tổng hợp cũ (không cần fetch) rồi gửi ảnh mới. Trả về số API call."""
+    calls = 0
+    if entry.get("img_msg_id"):
+        try: await channel.get_partial_message(entry["img_msg_id"]).delete()
+        except: pass
+        calls += 1
+        entry["img_msg_id"] = None
+    entry["img_hash"] = None
+    if players:
+        raw, fmt = await render_top_players(players)
+        summary_images[str(channel.id)] = (raw, f"image/{fmt}", _etag(raw))
+        img_msg = await channel.send(file=discord.File(fp=io.BytesIO(raw), filename=f"top_summary.{fmt}"))
+        entry["img_msg_id"] = img_msg.id
+        entry["img_hash"] = summary_digest(players)
+        calls += 1
+    return calls
+
+async def rebuild_board(channel, cid, data):
+    """Purge toàn bộ tin nhắn của bot rồi gửi lại từ đầu (chậm, chỉ dùng khi không đối chiếu được)."""
+    entry = data[cid]
+    players = list(entry["players"])
+    calls = 1
+    limit = 100 + len(entry.get("board", ()))
+    try: await channel.purge(limit=limit, check=lambda m: not m.pinned and m.author == channel.guild.me)
+    except: pass
     
-    if edit_mode:
-        for p in players:
-            if "msg_id" in p:
-                try:
-                    msg = await channel.fetch_message(p["msg_id"])
-                    await msg.edit(embed=get_embed(p))
+    board = []
+    for page in paginate(players):
+        embeds = [emb for _, emb in page]
+        msg = await channel.send(embeds=embeds)
+        assign_page(page, msg.id)
+        board.append({"msg_id": msg.id, "hash": page_digest(embeds)})
+        calls += 1
+    entry["board"] = board
+    entry["img_msg_id"] = None
+    calls += await send_summary(channel, entry, players)
+    return calls
+
+async def reconcile_board(channel, cid, data):
+    """
+    Đối chiếu board mong muốn (các trang 10 embed) với các message đã lưu:
+    chỉ edit message có nội dung khác, gửi thêm message ở cuối, xóa message thừa.
+    Trả về số API call đã dùng.
+    """
+    entry = data[cid]
+    players = list(entry["players"])
+    slots = board_slots(entry)
+    if not slots: return await rebuild_board(channel, cid, data)
+
+    calls = 0
+    pages = paginate(players)
+    surplus = slots[len(pages):]
+    del slots[len(pages):]
+    kept, tail = pages[:len(slots)], pages[len(slots):]
+
+    for slot, page in zip(slots, kept):
+        embeds = [emb for _, emb in page]
+        h = page_digest(embeds)
+        if slot["hash"] != h:
+            try: await channel.get_partial_message(slot["msg_id"]).edit(embeds=embeds)
+            except discord.NotFound:
+                # Có message bị xóa tay -> không giữ được thứ tự, dựng lại toàn bộ
+                return calls + await rebuild_board(channel, cid, data)
+            calls += 1
+            slot["hash"] = h
+        assign_page(page, slot["msg_id"])
+
+    if surplus:
+        try: await channel.delete_messages([discord.Object(id=s["msg_id"]) for s in surplus])
+        except:
+            for s in surplus:
+                try: await channel.get_partial_message(s["msg_id"]).delete()
                 except: pass
-        if "img_msg_id" in data[cid] and data[cid]["img_msg_id"]:
-            try:
-                old_img = await channel.fetch_message(data[cid]["img_msg_id"])
-                await old_img.delete()
+                calls += 1
+        else: calls += 1
+
+    if tail:
+        # Ảnh tổng hợp phải nằm dưới cùng -> xóa trước khi gửi thêm trang
+        if entry.get("img_msg_id"):
+            try: await channel.get_partial_message(entry["img_msg_id"]).delete()
             except: pass
-        if players:
-            new_file = await create_top_player_image(players)
-            img_msg = await channel.send(file=new_file)
-            data[cid]["img_msg_id"] = img_msg.id
-        save_json(DATA_FILE, data)
-        return
-
-    try: await channel.purge(limit=100, check=lambda m: not m.pinned and m.author == channel.guild.me)
-    except: pass
+            calls += 1
+            entry["img_msg_id"] = None
+        for page in tail:
+            embeds = [emb for _, emb in page]
+            msg = await channel.send(embeds=embeds)
+            assign_page(page, msg.id)
+            slots.append({"msg_id": msg.id, "hash": page_digest(embeds)})
+            calls += 1
+
+    if not entry.get("img_msg_id") or entry.get("img_hash") != summary_digest(players):
+        calls += await send_summary(channel, entry, players)
+    return calls
+
+async def update_board(channel, cid, data, edit_mode=False, changed=None):
+    """Cập nhật board của kênh, trả về số API call đã dùng (có đo thời gian/số call cho /metrics)."""
+    mode = "edit" if edit_mode else "reconcile"
+    with metrics.timer("topbot_board_update_seconds", mode=mode):
+        calls = await _update_board(channel, cid, data, edit_mode, changed)
+    metrics.observe("topbot_board_api_calls", calls, mode=mode)
+    return calls
+
+async def _update_board(channel, cid, data, edit_mode=False, changed=None):
+    """
+    Cập nhật board của kênh, trả về số API call đã dùng.
+    changed: các rank bị đổi (kết quả từ RankTable) -> edit_mode chỉ render lại các message chứa những rank này.
+    """
+    entry = data[cid]
+    table = entry["players"]
     
-    for p in players:
-        msg = await channel.send(embed=get_embed(p))
-        p["msg_id"] = msg.id
-        
-    if players:
-        img_file = await create_top_player_image(players)
-        img_msg = await channel.send(file=img_file)
-        data[cid]["img_msg_id"] = img_msg.id
-        
-    save_json(DATA_FILE, data)
+    if edit_mode:
+        # Edit thẳng qua PartialMessage (không fetch trước), chỉ message có hash khác, chạy song song
+        by_id = {s["msg_id"]: s for s in board_slots(entry)}
+        if changed is None: affected = set(by_id)
+        else: affected = {p.msg_id for p in map(table.get, changed) if p and p.msg_id}
+        pages = {}
+        for p in table:
+            if p.msg_id in affected: pages.setdefault(p.msg_id, []).append(p)
+        jobs, overflow = [], False
+        for msg_id, page in pages.items():
+            page.sort(key=lambda x: x.slot or 0)
+            embeds = [get_embed(p) for p in page]
+            if sum(len(e) for e in embeds) > EMBED_CHARS_PER_MESSAGE:
+                overflow = True  # trang dài hơn giới hạn sau khi sửa -> phải chia lại trang
+                break
+            h = page_digest(embeds)
+            slot = by_id.get(msg_id)
+            if slot is not None and slot["hash"] == h: continue
+            jobs.append((msg_id, embeds, h, slot))
+        if overflow: calls = await reconcile_board(channel, cid, data)
+        else:
+            limit = asyncio.Semaphore(EDIT_CONCURRENCY)
+            async def edit_one(msg_id, embeds, h, slot):
+                async with limit:
+                    try: await channel.get_partial_message(msg_id).edit(embeds=embeds)
+                    except discord.NotFound:
+                        if slot is not None: slot["hash"] = None  # để reconcile thử lại, gặp NotFound thì dựng lại board
+                        return False
+                    except discord.Forbidden: return True
+                    if slot is not None: slot["hash"] = h
+                    return True
+            results = await asyncio.gather(*(edit_one(*job) for job in jobs))
+            calls = len(jobs)
+            if not all(results):
+                # Có message bị xóa tay -> để reconcile_board sửa lại board
+                calls += await reconcile_board(channel, cid, data)
+            elif not entry.get("img_msg_id") or entry.get("img_hash") != summary_digest(table.top(10)):
+                calls += await send_summary(channel, entry, table.top(10))
+    else:
+        calls = await reconcile_board(channel, cid, data)
+
+    # Bot vừa tự gửi các message này -> lần quét lịch sử sau chỉ cần đọc phần mới hơn
+    sent = [s["msg_id"] for s in entry.get("board", [])] + [entry.get("img_msg_id") or 0]
+    entry["scan_checkpoint"] = max([entry.get("scan_checkpoint") or 0] + sent)
+    print(f"📊 Board {cid}: {calls} API calls")
+    store.mark_dirty(cid)
+    return calls
+
+BOARD_DEBOUNCE = 1.0      # giây gom các lệnh sửa board liên tiếp thành một lần cập nhật
+BOARD_MAX_RETRIES = 3     # số lần thử lại khi vẫn bị 429 sau khi discord.py đã tự chờ
+
+class BoardScheduler:
+    """
+    Hàng đợi cập nhật board theo kênh: lệnh chỉ sửa dữ liệu rồi báo "board dirty".
+    Mỗi kênh có đúng một worker gom các yêu cầu trong BOARD_DEBOUNCE giây thành một lần
+    update_board (nên các lệnh không chạy đua nhau), các kênh khác nhau vẫn chạy song song.
+    Việc chờ theo bucket của từng route do discord.py lo (đọc header X-RateLimit-*);
+    nếu 429 vẫn lọt ra ngoài thì worker chờ Retry-After rồi đối chiếu lại.
+    """
+    def __init__(self, debounce=BOARD_DEBOUNCE):
+        self.debounce = debounce
+        self._pending = {}  # cid -> yêu cầu đang gom
+        self._workers = {}  # cid -> Task
+
+    def request(self, channel, cid, edit_mode=False, changed=None):
+        """Đánh dấu board dirty. Trả về Future hoàn tất (số API call) khi lần cập nhật chứa yêu cầu này xong."""
+        loop = asyncio.get_running_loop()
+        req = self._pending.get(cid)
+        if req is None:
+            req = self._pending[cid] = {"channel": channel, "full": False, "changed": set(), "waiters": []}
+        req["channel"] = channel
+        if not edit_mode: req["full"] = True
+        if changed is None: req["changed"] = None
+        elif req["changed"] is not None: req["changed"].update(changed)
+        fut = loop.create_future()
+        req["waiters"].append(fut)
+        task = self._workers.get(cid)
+        if task is None or task.done():
+            self._workers[cid] = loop.create_task(self._run(cid))
+        return fut
+
+    async def _run(self, cid):
+        while cid in self._pending:
+            await asyncio.sleep(self.debounce)
+            req = self._pending.pop(cid)
+            try: calls = await self._apply(cid, req)
+            except Exception as e:
+                for fut in req["waiters"]:
+                    if not fut.done(): fut.set_exception(e)
+            else:
+                for fut in req["waiters"]:
+                    if not fut.done(): fut.set_result(calls)
+
+    async def _apply(self, cid, req):
+        changed = None if req["full"] or req["changed"] is None else sorted(req["changed"])
+        for attempt in range(BOARD_MAX_RETRIES):
+            try: return await update_board(req["channel"], cid, store.data, edit_mode=not req["full"], changed=changed)
+            except discord.HTTPException as e:
+                if e.status != 429 or attempt == BOARD_MAX_RETRIES - 1: raise
+                retry_after = float(e.response.headers.get("Retry-After", 5))
+                print(f"⏳ Board {cid} bị rate limit, thử lại sau {retry_after:.1f}s")
+                await asyncio.sleep(retry_after)
+
+boards = BoardScheduler()
+
+# --- 7b. IMPORT / EXPORT ---
+IMPORT_FIELDS = ["top", "mention_id", "username", "displayname", "stage", "roblox_id", "country"]
+IMPORT_MAX_BYTES = 1024 * 1024
+IMPORT_MAX_ERRORS = 10  # số lỗi tối đa liệt kê trong phản hồi
+
+def parse_board_file(filename, raw):
+    """Đọc file CSV/JSON thành list dict. JSON nhận list, hoặc {"players": [...]} như file export."""
+    text = raw.decode("utf-8-sig")
+    if filename.lower().endswith(".json") or text.lstrip().startswith(("[", "{")):
+        rows = json.loads(text)
+        if isinstance(rows, dict): rows = rows.get("players", [])
+        if not isinstance(rows, list): raise ValueError("JSON must be a list of players")
+        return rows
+    return list(csv.DictReader(io.StringIO(text)))
+
+def validate_rows(rows):
+    """Kiểm tra toàn bộ các dòng trước khi áp dụng. Trả về (list PlayerRecord, list lỗi)."""
+    records, errors, seen = [], [], set()
+    mention_re = re.compile(r"^<@!?(\d+)>$")
+    for n, row in enumerate(rows, start=1):
+        if not isinstance(row, dict):
+            errors.append(f"#{n}: not an object"); continue
+        row = {k.strip().lower(): (str(v).strip() if v is not None else "") for k, v in row.items() if k}
+        top, mention = row.get("top", ""), row.get("mention_id") or row.get("mention", "")
+        m = mention_re.match(mention)
+        if m: mention = m.group(1)
+        stage = row.get("stage", "").lower()
+        problems = []
+        if not top.isdigit() or int(top) < 1: problems.append("top")
+        elif int(top) in seen: problems.append("duplicate top")
+        if not mention.isdigit(): problems.append("mention_id")
+        if not row.get("displayname"): problems.append("displayname")
+        if stage not in RANK_ROLES: problems.append("stage")
+        if not row.get("roblox_id", "").isdigit(): problems.append("roblox_id")
+        if not row.get("country"): problems.append("country")
+        if problems:
+            errors.append(f"#{n}: {', '.join(problems)}"); continue
+        seen.add(int(top))
+        records.append(PlayerRecord(top, username=row.get("username", ""), mention_id=int(mention), displayname=row["displayname"],
+                                    stage=stage, roblox_id=row["roblox_id"], country=row["country"]))
+    return records, errors
+
+def export_board(table, fmt):
+    """Board của kênh dưới dạng bytes CSV/JSON, cùng các cột mà import nhận."""
+    rows = [{k: v for k, v in rec.to_dict().items() if k in IMPORT_FIELDS} for rec in table]
+    if fmt == "csv":
+        buf = io.StringIO()
+        writer = csv.DictWriter(buf, fieldnames=IMPORT_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+        return buf.getvalue().encode("utf-8")
+    return json.dumps({"players": rows}, indent=4, ensure_ascii=False).encode("utf-8")
+
+async def import_board(guild, cid, data, records, replace=False):
+    """
+    Áp dụng các dòng đã validate: avatar resolve theo batch, username thiếu thì tra member song song,
+    role cập nhật trong một lượt. Board được dựng lại đúng một lần bởi người gọi.
+    """
+    urls = await thumbnails.resolve_many([r.roblox_id for r in records])
+    limit = asyncio.Semaphore(ROLE_SYNC_WORKERS)
+    async def fill(rec):
+        rec.avatar_url = urls.get(str(rec.roblox_id), "")
+        rec.avatar_at = time.time() if rec.avatar_url else 0
+        if not rec.username and guild:
+            async with limit: member = await members.get(guild, rec.mention_id)
+            rec.username = member.name if member else rec.displayname
+    await asyncio.gather(*(fill(r) for r in records))
+
+    if cid not in data: data[cid] = new_channel_entry()
+    entry = data[cid]
+    if replace:
+        # Giữ msg_id/slot của vị trí cũ để reconcile chỉ cần edit thay vì gửi lại
+        old = {p.rank: p for p in entry["players"]}
+        for rec in records:
+            if rec.rank in old: rec.msg_id, rec.slot = old[rec.rank].msg_id, old[rec.rank].slot
+        entry["players"] = RankTable(records)
+    else:
+        for rec in records: entry["players"].insert(rec)
+    store.mark_dirty(cid)
+    if not guild: return (0, 0, 0)
+    # Duyệt theo thứ tự rank của bảng để mỗi member nhận role của rank cao nhất họ đang giữ
+    imported = {r.mention_id for r in records}
+    return await sync_board_roles(guild, [p for p in entry["players"] if p.mention_id in imported])
 
 # --- 8. BOT COMMANDS ---
-class TopBot(commands.Bot):
+def build_intents():
+    if not LEAN_GATEWAY: return discord.Intents.all()
+    intents = discord.Intents.none()
+    intents.guilds = True
+    return intents
+
+def observe_command(interaction, status):
+    t0 = interaction.extras.get("t0")
+    if t0 is None or interaction.command is None: return
+    metrics.observe("topbot_command_seconds", time.perf_counter() - t0, command=interaction.command.qualified_name, status=status)
+
+class TopTree(app_commands.CommandTree):
+    async def interaction_check(self, interaction):
+        interaction.extras["t0"] = time.perf_counter()
+        return True
+    async def on_error(self, interaction, error):
+        observe_command(interaction, "error")
+        await super().on_error(interaction, error)
+
+def command_tree_hash(tree, application_id=None):
+    """Hash của payload slash command (gồm cả group topplayer) đúng như tree.sync() sẽ gửi lên."""
+    payload = sorted((cmd.to_dict(tree) for cmd in tree.get_commands()), key=lambda d: (d.get("type", 1), d["name"]))
+    raw = json.dumps({"app": application_id, "commands": payload}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+async def sync_commands(tree, application_id=None):
+    """Chỉ gọi tree.sync() khi cây lệnh khác lần sync trước, tránh đốt rate limit global mỗi lần restart."""
+    digest = command_tree_hash(tree, application_id)
+    try:
+        with open(COMMAND_HASH_FILE, encoding="utf-8") as f:
+            if f.read().strip() == digest:
+                print("⏭️ Command tree unchanged, skipping sync")
+                return False
+    except OSError: pass
+    synced = await tree.sync()
+    _atomic_write(COMMAND_HASH_FILE, digest)
+    print(f"🔄 Synced {len(synced)} commands")
+    return True
+
+class TopBot(commands.AutoShardedBot if SHARDED else commands.Bot):
     def __init__(self):
-        super().__init__(command_prefix="!", intents=discord.Intents.all())
+        options = {}
+        if LEAN_GATEWAY:
+            # Không giữ member/message trong RAM: slash command đã gửi kèm dữ liệu member cần thiết
+            options = {"member_cache_flags": discord.MemberCacheFlags.none(), "max_messages": None, "chunk_guilds_at_startup": False}
+        super().__init__(command_prefix="!", intents=build_intents(), tree_cls=TopTree, **options)
+        self.session = None  # aiohttp session dùng chung cho Roblox API + CDN
+        self.web_runner = None
+        self.startup_seconds = None
+        instrument_http(self.http)
     async def setup_hook(self):
-        await self.tree.sync()
+        connector = aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, limit_per_host=HTTP_PER_HOST, ttl_dns_cache=300)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=HTTP_TIMEOUT)
+        self.web_runner = await start_web_server()
+        await sync_commands(self.tree, self.application_id)
         print(f"✅ Bot Online: {self.user}")
+        self.loop.create_task(self.warm_up())
+    async def warm_up(self):
+        await self.wait_until_ready()
+        self.startup_seconds = time.perf_counter() - BOOT_STARTED
+        print(f"🚀 Ready in {self.startup_seconds:.2f}s (cold start)")
+        await warm_channels(store.data)
+        print(f"✅ Warmed {len(store.data)} leaderboard channels")
+    async def close(self):
+        await store.flush()
+        await super().close()
+        if self.session: await self.session.close()
+        if self.web_runner: await self.web_runner.cleanup()
 
 bot = TopBot()
+metrics.gauge("topbot_gateway_latency_seconds", lambda: bot.latency, "Độ trễ heartbeat gateway")
+metrics.gauge("topbot_startup_seconds", lambda: bot.startup_seconds or 0, "Thời gian từ lúc khởi động tiến trình tới khi ready")
+metrics.gauge("topbot_connected", lambda: int(bot.is_ready() and not bot.is_closed()), "1 nếu bot đang kết nối gateway")
+
+@bot.listen("on_app_command_completion")
+async def on_command_done(interaction, command):
+    observe_command(interaction, "ok")
+
+@bot.listen("on_guild_role_create")
+@bot.listen("on_guild_role_delete")
+async def on_rank_role_changed(role):
+    rank_roles.invalidate(role.guild.id)
+
+@bot.listen("on_guild_role_update")
+async def on_rank_role_updated(before, after):
+    rank_roles.invalidate(after.guild.id)
 
 # --- STANDALONE MOD COMMANDS ---
 @bot.tree.command(name="blacklist", description="Ban/Unban user")
@@ -274,19 +1566,16 @@ bot = TopBot()
 @app_commands.choices(action=[app_commands.Choice(name="Add", value="add"), app_commands.Choice(name="Remove", value="remove"), app_commands.Choice(name="Check", value="check")])
 async def blacklist(interaction: discord.Interaction, action: app_commands.Choice[str], user: discord.Member, reason: str = "No reason"):
     if not is_authorized(interaction): return await interaction.response.send_message("❌ Owner/Admin Only.", ephemeral=True)
-    blacklist_data = load_json(BLACKLIST_FILE)
     embed = discord.Embed(color=0x000000)
     
     if action.value == "add":
-        blacklist_data[str(user.id)] = {"reason": reason, "by": interaction.user.name}
-        save_json(BLACKLIST_FILE, blacklist_data)
+        perms.ban(user.id, reason, interaction.user.name)
         embed.title = "🚫 Blacklisted"; embed.description = f"{user.mention} banned."
     elif action.value == "remove":
-        if str(user.id) in blacklist_data: del blacklist_data[str(user.id)]
-        save_json(BLACKLIST_FILE, blacklist_data)
+        perms.unban(user.id)
         embed.title = "✅ Unblacklisted"; embed.description = f"{user.mention} unbanned."
     elif action.value == "check":
-        status = "BANNED" if str(user.id) in blacklist_data else "CLEAN"
+        status = "BANNED" if perms.is_blacklisted(user.id) else "CLEAN"
         embed.title = f"Status: {status}"; embed.description = f"Check for {user.mention}"
         
     await interaction.response.send_message(embed=embed, ephemeral=True)
@@ -326,23 +1615,20 @@ async def added(interaction: discord.Interaction, top: int, mention: discord.Mem
     if not is_authorized(interaction): return await interaction.response.send_message("❌ Denied.", ephemeral=True)
     await interaction.response.defer(ephemeral=True)
     
-    data = load_json(DATA_FILE); cid = str(interaction.channel_id)
+    data = store.data; cid = str(interaction.channel_id)
     # TỰ ĐỘNG SYNC DỮ LIỆU CŨ NẾU FILE TRỐNG
     await ensure_data_sync(interaction, data, cid)
     
-    url = f"https://thumbnails.roblox.com/v1/users/avatar-headshot?userIds={roblox_id}&size=150x150&format=Png"
-    async with aiohttp.ClientSession() as s:
-        async with s.get(url) as r:
-            av = (await r.json())['data'][0]['imageUrl'] if r.status == 200 else ""
+    av = await thumbnails.resolve(roblox_id)
             
-    entry = {"top": str(top), "username": mention.name, "mention_id": mention.id, "displayname": displayname, "stage": stage.value, "roblox_id": roblox_id, "country": country, "avatar_url": av}
-    data[cid]["players"] = [p for p in data[cid]["players"] if p['top'] != str(top)]
-    data[cid]["players"].append(entry)
+    entry = PlayerRecord(top, username=mention.name, mention_id=mention.id, displayname=displayname, stage=stage.value, roblox_id=roblox_id, country=country, avatar_url=av, avatar_at=time.time() if av else 0)
+    data[cid]["players"].insert(entry)
+    store.mark_dirty(cid)
     
     # Cập nhật Role
-    await manage_roles(interaction.guild, mention.id, stage.value)
+    await manage_roles(interaction.guild, mention, stage.value)
     
-    await update_board(interaction.channel, cid, data)
+    await boards.request(interaction.channel, cid)
     await interaction.followup.send("✅ Added & Synced.")
 
 @group.command(name="edit", description="Edit Rank")
@@ -357,30 +1643,30 @@ async def edit(interaction: discord.Interaction, top: int, mention: discord.Memb
     if not is_authorized(interaction): return await interaction.response.send_message("❌ Denied.", ephemeral=True)
     await interaction.response.defer(ephemeral=True)
     
-    data = load_json(DATA_FILE); cid = str(interaction.channel_id)
+    data = store.data; cid = str(interaction.channel_id)
     await ensure_data_sync(interaction, data, cid) # Auto Sync
     
-    p = next((x for x in data.get(cid, {}).get("players", []) if x['top'] == str(top)), None)
+    table = data[cid]["players"] if cid in data else RankTable()
+    p = table.get(top)
     if not p: return await interaction.followup.send("❌ Rank not found.")
     
-    if mention: p["username"], p["mention_id"] = mention.name, mention.id
-    if displayname: p["displayname"] = displayname
-    if country: p["country"] = country
+    fields = {}
+    if mention: fields.update(username=mention.name, mention_id=mention.id)
+    if displayname: fields["displayname"] = displayname
+    if country: fields["country"] = country
     if stage: 
-        p["stage"] = stage.value
+        fields["stage"] = stage.value
         # Cập nhật Role nếu đổi Stage
-        target_uid = mention.id if mention else p["mention_id"]
-        await manage_roles(interaction.guild, target_uid, stage.value)
+        await manage_roles(interaction.guild, mention or p.mention_id, stage.value)
         
     if roblox_id:
-        p["roblox_id"] = roblox_id
-        url = f"https://thumbnails.roblox.com/v1/users/avatar-headshot?userIds={roblox_id}&size=150x150&format=Png"
-        async with aiohttp.ClientSession() as s:
-            async with s.get(url) as r:
-                if r.status == 200: p["avatar_url"] = (await r.json())['data'][0]['imageUrl']
+        fields["roblox_id"] = roblox_id
+        av = await thumbnails.resolve(roblox_id)
+        if av: fields.update(avatar_url=av, avatar_at=time.time())
                 
-    save_json(DATA_FILE, data)
-    await update_board(interaction.channel, cid, data, edit_mode=True)
+    table.update(top, **fields)
+    store.mark_dirty(cid)
+    await boards.request(interaction.channel, cid, edit_mode=True, changed=[top])
     await interaction.followup.send(f"✅ Updated Rank {top}.")
 
 @group.command(name="move", description="Move Rank")
@@ -389,25 +1675,14 @@ async def move(interaction: discord.Interaction, current_top: int, new_top: int)
     if not is_authorized(interaction): return await interaction.response.send_message("❌ Denied.", ephemeral=True)
     await interaction.response.defer(ephemeral=True)
     
-    data = load_json(DATA_FILE); cid = str(interaction.channel_id)
+    data = store.data; cid = str(interaction.channel_id)
     await ensure_data_sync(interaction, data, cid) # Auto Sync
     
-    players = data.get(cid, {}).get("players", [])
-    players.sort(key=lambda x: int(x['top']))
-    src = next((i for i, p in enumerate(players) if p['top'] == str(current_top)), None)
-    dst = next((i for i, p in enumerate(players) if p['top'] == str(new_top)), None)
+    changed = data[cid]["players"].move(current_top, new_top) if cid in data else None
     
-    if src is not None and dst is not None:
-        src_data = {k: v for k, v in players[src].items() if k not in ["top", "msg_id"]}
-        if src > dst:
-            for i in range(src, dst, -1):
-                for k, v in {k:v for k,v in players[i-1].items() if k not in ["top","msg_id"]}.items(): players[i][k] = v
-        else:
-            for i in range(src, dst):
-                for k, v in {k:v for k,v in players[i+1].items() if k not in ["top","msg_id"]}.items(): players[i][k] = v
-        for k, v in src_data.items(): players[dst][k] = v
-        save_json(DATA_FILE, data)
-        await update_board(interaction.channel, cid, data, edit_mode=True)
+    if changed is not None:
+        store.mark_dirty(cid)
+        await boards.request(interaction.channel, cid, edit_mode=True, changed=changed)
         await interaction.followup.send(f"⏩ Moved.")
     else: await interaction.followup.send("❌ Error.")
 
@@ -415,17 +1690,13 @@ async def move(interaction: discord.Interaction, current_top: int, new_top: int)
 async def exchange(interaction: discord.Interaction, rank1: int, rank2: int):
     if not is_authorized(interaction): return await interaction.response.send_message("❌ Denied.", ephemeral=True)
     await interaction.response.defer(ephemeral=True)
-    data = load_json(DATA_FILE); cid = str(interaction.channel_id)
+    data = store.data; cid = str(interaction.channel_id)
     await ensure_data_sync(interaction, data, cid)
     
-    players = data.get(cid, {}).get("players", [])
-    p1 = next((p for p in players if str(p['top']) == str(rank1)), None)
-    p2 = next((p for p in players if str(p['top']) == str(rank2)), None)
-    if p1 and p2:
-        keys = ["username", "mention_id", "displayname", "stage", "roblox_id", "country", "avatar_url"]
-        for k in keys: p1[k], p2[k] = p2[k], p1[k]
-        save_json(DATA_FILE, data)
-        await update_board(interaction.channel, cid, data, edit_mode=True)
+    changed = data[cid]["players"].swap(rank1, rank2) if cid in data else None
+    if changed is not None:
+        store.mark_dirty(cid)
+        await boards.request(interaction.channel, cid, edit_mode=True, changed=changed)
         await interaction.followup.send(f"🔄 Swapped.")
     else: await interaction.followup.send("❌ Not found.")
 
@@ -434,50 +1705,110 @@ async def remove(interaction: discord.Interaction, top: int):
     if is_blacklisted(interaction.user.id): return await interaction.response.send_message("🚫 Blacklisted.", ephemeral=True)
     if not is_authorized(interaction): return await interaction.response.send_message("❌ Denied.", ephemeral=True)
     await interaction.response.defer(ephemeral=True)
-    data = load_json(DATA_FILE); cid = str(interaction.channel_id)
+    data = store.data; cid = str(interaction.channel_id)
     await ensure_data_sync(interaction, data, cid) # Auto Sync
     
     if cid in data:
-        data[cid]["players"] = [p for p in data[cid]["players"] if p['top'] != str(top)]
-        await update_board(interaction.channel, cid, data)
+        data[cid]["players"].remove(top)
+        store.mark_dirty(cid)
+        await boards.request(interaction.channel, cid)
         await interaction.followup.send(f"🗑️ Removed.")
 
 @group.command(name="run", description="Manual Sync & Refresh")
-async def run_cmd(interaction: discord.Interaction):
+@app_commands.describe(rescan="Rescan the whole channel history, ignoring the saved checkpoint")
+async def run_cmd(interaction: discord.Interaction, rescan: bool = False):
     if not is_authorized(interaction): return await interaction.response.send_message("❌ Denied.")
     await interaction.response.defer(ephemeral=True)
-    data = load_json(DATA_FILE); cid = str(interaction.channel_id)
-    await ensure_data_sync(interaction, data, cid) # Gọi hàm Sync
-    await update_board(interaction.channel, cid, data)
+    data = store.data; cid = str(interaction.channel_id)
+    if rescan: await recover_channel(interaction.channel, cid, data, full=True)  # checkpoint sai -> quét lại từ đầu
+    else: await ensure_data_sync(interaction, data, cid) # Gọi hàm Sync
+    await boards.request(interaction.channel, cid)
     await interaction.followup.send("✅ Synced & Refreshed.")
 
+@group.command(name="import", description="Import players from a CSV/JSON file")
+async def import_cmd(interaction: discord.Interaction, file: discord.Attachment, replace: bool = False):
+    if is_blacklisted(interaction.user.id): return await interaction.response.send_message("🚫 Blacklisted.", ephemeral=True)
+    if not is_authorized(interaction): return await interaction.response.send_message("❌ Denied.", ephemeral=True)
+    await interaction.response.defer(ephemeral=True)
+    if file.size > IMPORT_MAX_BYTES: return await interaction.followup.send("❌ File too large.")
+    try: rows = parse_board_file(file.filename, await file.read())
+    except (ValueError, UnicodeDecodeError, csv.Error) as e: return await interaction.followup.send(f"❌ Cannot read file: {e}")
+    
+    records, errors = validate_rows(rows)
+    if errors:
+        shown = "\n".join(errors[:IMPORT_MAX_ERRORS])
+        more = f"\n… +{len(errors) - IMPORT_MAX_ERRORS}" if len(errors) > IMPORT_MAX_ERRORS else ""
+        return await interaction.followup.send(f"❌ {len(errors)} invalid rows, nothing imported:\n{shown}{more}")
+    if not records: return await interaction.followup.send("❌ Empty file.")
+    
+    data = store.data; cid = str(interaction.channel_id)
+    await ensure_data_sync(interaction, data, cid) # Auto Sync
+    updated, _, missing = await import_board(interaction.guild, cid, data, records, replace)
+    await boards.request(interaction.channel, cid)
+    await interaction.followup.send(f"✅ Imported {len(records)} players ({updated} roles updated, {missing} members not found).")
+
+@group.command(name="export", description="Export this channel's board")
+@app_commands.choices(fmt=[app_commands.Choice(name="JSON", value="json"), app_commands.Choice(name="CSV", value="csv")])
+async def export_cmd(interaction: discord.Interaction, fmt: app_commands.Choice[str] = None):
+    if not is_authorized(interaction): return await interaction.response.send_message("❌ Denied.", ephemeral=True)
+    await interaction.response.defer(ephemeral=True)
+    data = store.data; cid = str(interaction.channel_id)
+    await ensure_data_sync(interaction, data, cid) # Auto Sync
+    if cid not in data or not data[cid]["players"]: return await interaction.followup.send("❌ Empty board.")
+    
+    ext = fmt.value if fmt else "json"
+    raw = export_board(data[cid]["players"], ext)
+    await interaction.followup.send(file=discord.File(io.BytesIO(raw), filename=f"topplayers_{cid}.{ext}"))
+
+@group.command(name="refreshavatars", description="Refresh expired avatars")
+async def refreshavatars(interaction: discord.Interaction, force: bool = False):
+    if is_blacklisted(interaction.user.id): return await interaction.response.send_message("🚫 Blacklisted.", ephemeral=True)
+    if not is_authorized(interaction): return await interaction.response.send_message("❌ Denied.", ephemeral=True)
+    await interaction.response.defer(ephemeral=True)
+    data = store.data; cid = str(interaction.channel_id)
+    await ensure_data_sync(interaction, data, cid) # Auto Sync
+    
+    stale = [p for p in data[cid]["players"] if force or avatar_is_stale(p)] if cid in data else []
+    if not stale: return await interaction.followup.send("✅ All avatars are fresh.")
+    # Vài request batch cho cả board thay vì một request mỗi người
+    urls = await thumbnails.resolve_many([p.roblox_id for p in stale], refresh=True)
+    changed = []
+    for p in stale:
+        av = urls.get(str(p.roblox_id))
+        if not av: continue
+        if av != p.avatar_url: changed.append(p.rank)
+        p.avatar_url, p.avatar_at = av, time.time()
+    
+    store.mark_dirty(cid)
+    if changed: await boards.request(interaction.channel, cid, edit_mode=True, changed=changed)
+    await interaction.followup.send(f"🖼️ Refreshed {len(changed)}/{len(stale)} avatars.")
+
+@group.command(name="syncroles", description="Sync rank roles with the board")
+async def syncroles(interaction: discord.Interaction):
+    if is_blacklisted(interaction.user.id): return await interaction.response.send_message("🚫 Blacklisted.", ephemeral=True)
+    if not is_authorized(interaction): return await interaction.response.send_message("❌ Denied.", ephemeral=True)
+    await interaction.response.defer(ephemeral=True)
+    data = store.data; cid = str(interaction.channel_id)
+    await ensure_data_sync(interaction, data, cid) # Auto Sync
+    if cid not in data or not interaction.guild: return await interaction.followup.send("❌ Empty board.")
+    
+    updated, unchanged, missing = await sync_board_roles(interaction.guild, data[cid]["players"])
+    await interaction.followup.send(f"👥 Roles synced: {updated} updated, {unchanged} unchanged, {missing} not found.")
+
 @group.command(name="permissions", description="Grant Access")
 async def permissions(interaction: discord.Interaction, role: discord.Role = None, user: discord.Member = None):
     if interaction.user.id != BOT_OWNER_ID: return await interaction.response.send_message("⚠️ Owner Only.")
-    auth = load_json(AUTH_FILE); gid = str(interaction.guild_id)
-    if gid not in auth: auth[gid] = {"roles": [], "users": []}
-    if role: auth[gid]["roles"].append(role.id)
-    if user: auth[gid]["users"].append(user.id)
-    save_json(AUTH_FILE, auth)
+    perms.grant(str(interaction.guild_id), role.id if role else None, user.id if user else None)
     await interaction.response.send_message("✅ Granted.")
 
 @group.command(name="removeperm", description="Revoke Access")
 async def removeperm(interaction: discord.Interaction, role: discord.Role = None, user: discord.Member = None):
     if interaction.user.id != BOT_OWNER_ID: return await interaction.response.send_message("⚠️ Owner Only.")
-    auth = load_json(AUTH_FILE); gid = str(interaction.guild_id)
-    if gid in auth:
-        if role and role.id in auth[gid].get("roles", []): auth[gid]["roles"].remove(role.id)
-        if user and user.id in auth[gid].get("users", []): auth[gid]["users"].remove(user.id)
-        save_json(AUTH_FILE, auth)
+    perms.revoke(str(interaction.guild_id), role.id if role else None, user.id if user else None)
     await interaction.response.send_message("🗑️ Revoked.")
 
 bot.tree.add_command(group)
 
-if __name__ == "__main__":
-    keep_alive()
-    bot.run(TOKEN)
-
-# Thêm vào cuối file, trước bot.run(TOKEN)
 async def close_bot():
     await bot.close()
 
@@ -485,14 +1816,13 @@ def handler(signum, frame):
     print("Stopping bot...")
     bot.loop.create_task(close_bot())
 
-signal.signal(signal.SIGINT, handler)
-signal.signal(signal.SIGTERM, handler)
-
-# Sau đó mới chạy bot
-try:
-    bot.run(TOKEN)
-except discord.errors.HTTPException as e:
-    if e.status == 429:
-        print("BỊ RATE LIMIT RỒI! Hãy đợi 30-60 phút rồi khởi động lại.")
-    else:
-        raise e
+if __name__ == "__main__":
+    signal.signal(signal.SIGINT, handler)
+    signal.signal(signal.SIGTERM, handler)
+    try:
+        bot.run(TOKEN)
+    except discord.errors.HTTPException as e:
+        if e.status == 429:
+            print("BỊ RATE LIMIT RỒI! Hãy đợi 30-60 phút rồi khởi động lại.")
+        else:
+            raise e